@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+# HISTORY ARCHIVER FOR TIFMASTER
+#
+# Moves the credits and debits dated before the cutoff (by default the
+# start of the median range, the earliest it may be) out of the ledger
+# into TIF_archive.txt.gz, leaving a summary record per keyholder so
+# every balance stays the same.  Loading the chart never reads the
+# archive; only history queries reaching back past the cutoff do.
+#
+#   archive.py [-c chart directory] [cutoff date]
+
+import tif
+from tif import from_iso
+import sys
+import getopt
+
+if __name__=='__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'c:')
+    chart = tif.chart
+    for (opt, value) in opts:
+        if opt == '-c': chart = tif.Ledger(value)
+    chart.load()
+    cutoff = from_iso(args[0]) if args else chart.min_median_date()
+    count = chart.archive_before(cutoff)
+    chart.save()
+    if isinstance(chart.storage, tif.TextStorage):
+        # Rewrite the ledger files now rather than leave it to the journal
+        chart.compact()
+        chart.write_snapshot()
+    print "Archived %d records from before %s." % (count, cutoff)
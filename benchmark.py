@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+# BENCHMARKS FOR TIFMASTER
+#
+# Generates a synthetic chart (see synthetic.py) in a scratch directory
+# and times the main operations on it, best of -r runs each.  Every run
+# is appended as a line of JSON to the results file (-o, default
+# benchmark_results.jsonl), and compared with the previous run at the
+# same sizes, so regressions show up run to run.
+#
+#   benchmark.py [-r repeat] [-o results file] [synthetic.py options]
+
+import tif
+import process_hours
+import summary
+import synthetic
+import timeit
+import tempfile
+import shutil
+import subprocess
+import platform
+import json
+import glob
+import time
+import sys
+import os
+import getopt
+
+RESULTS_FN = "benchmark_results.jsonl"
+
+def best(f,repeat,setup=lambda: ()):
+    """The shortest of $repeat$ timings of $f$(*setup()), in seconds;
+    $setup$ itself isn't timed."""
+    times = []
+    for i in range(repeat):
+        args = setup()
+        start = timeit.default_timer()
+        f(*args)
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+def loaded(directory,snapshot=False):
+    chart = tif.Ledger(directory, tif.TextStorage())
+    chart.load(snapshot=snapshot)
+    return chart
+
+def run(directory,repeat=3):
+    """Time each operation on the chart in $directory$.  Returns a dict
+    of name to seconds."""
+    fns = sorted(glob.glob(os.path.join(directory, 'week_of_*.txt')))
+    devnull = open(os.devnull,'w')
+    timings = dict()
+    timings['load'] = best(lambda: loaded(directory), repeat)
+    loaded(directory, snapshot=True) # writes the snapshot
+    timings['load_snapshot'] = best(lambda: loaded(directory, True), repeat)
+    chart = loaded(directory)
+    timings['read_hours_files'] = best(
+        lambda: process_hours.read_hours_files(fns, chart=chart), repeat)
+    def fork():
+        fork = chart.fork()
+        return (process_hours.read_hours_files(fns, chart=fork),
+                fork, devnull)
+    timings['update_hours'] = best(process_hours.update_hours, repeat, fork)
+    def rebuild():
+        chart.median_index.invalidate()
+        return ()
+    timings['compute_median'] = best(chart.compute_median, repeat, rebuild)
+    scratch = os.path.join(directory, 'scratch.txt')
+    timings['write_credits'] = best(lambda: chart.write_credits(scratch), repeat)
+    timings['write_debits'] = best(lambda: chart.write_debits(scratch), repeat)
+    def summarize():
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            summary.summary(tif.Ledger(directory, tif.TextStorage()))
+        finally:
+            sys.stdout = stdout
+    timings['summary'] = best(summarize, repeat)
+    devnull.close()
+    return timings
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull,'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous(results_fn,sizes):
+    """The last recorded run at $sizes$, or None."""
+    last = None
+    if os.path.exists(results_fn):
+        with open(results_fn,'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['sizes'] == sizes:
+                    last = entry
+    return last
+
+def benchmark(sizes,repeat=3,results_fn=RESULTS_FN):
+    """Generate a chart of $sizes$ (synthetic.generate's options), time
+    it, print and record the results."""
+    directory = tempfile.mkdtemp(prefix='tif_benchmark_')
+    try:
+        synthetic.generate(directory, **sizes)
+        timings = run(directory, repeat)
+    finally:
+        shutil.rmtree(directory)
+    last = previous(results_fn, sizes)
+    print "%-18s%12s%12s" % ("Operation", "Seconds", "vs. last")
+    for name in sorted(timings):
+        change = ""
+        if last and last['timings'].get(name):
+            change = "%.2fx" % (timings[name] / last['timings'][name])
+        print "%-18s%12.4f%12s" % (name, timings[name], change)
+    with open(results_fn,'a') as f:
+        f.write(json.dumps(dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                revision=revision(),
+                                python=platform.python_version(),
+                                sizes=sizes, repeat=repeat,
+                                timings=timings), sort_keys=True) + "\n")
+    return timings
+
+if __name__=='__main__':
+    opts, args = getopt.getopt(sys.argv[1:],
+                               'r:o:' + ':'.join(synthetic.OPTIONS) + ':')
+    repeat = 3
+    results_fn = RESULTS_FN
+    sizes = dict(keyholders=30, years=1, weeks=4)
+    for (opt, value) in opts:
+        if opt == '-r': repeat = int(value)
+        elif opt == '-o': results_fn = value
+        else:
+            name, kind = synthetic.OPTIONS[opt[1]]
+            sizes[name] = kind(value)
+    benchmark(sizes, repeat, results_fn)
@@ -5,14 +5,29 @@
 # Accepts a template schedule for the first week of term, and creates
 # weekly schedules up to a given end date, advancing the days appropriately
 # but leaving the hours assignments unchanged.
+#
+#   create_weeks.py [first week schedule.txt] [end date]
+#       writes a week_of_YYYY-MM-DD.txt for each week
+#   create_weeks.py -o schedule.txt [first week schedule.txt] [end date]
+#       writes every week into the one file, which process_hours.py
+#       takes like any other
+#   create_weeks.py -p [-c chart directory] [first week schedule.txt] [end date]
+#       processes the schedule straight into the chart, as
+#       process_hours.py would, without writing any hours files
 
 # FIXME This is terribly non-idiomatic.  Separate dates and hours
 # lists are silly; we can just pass a value of type [(date,hours)]
 # around, extend it to enddate, then write that.
 
+import tif
+import process_hours
 from tif import from_iso
 from datetime import date,timedelta
+from itertools import islice
 import sys
+import getopt
+
+WEEK = timedelta(days=7)
 
 def read_proto(filename):
     dates=[]
@@ -27,29 +42,75 @@ def read_proto(filename):
             hours.append(all_hours)
     return (dates,hours)
 
+def schedule(dates,hours,enddate):
+    """Every line of the schedule, each week of it starting on or
+    before $enddate$, generated as needed."""
+    shift = timedelta(0)
+    while dates[0] + shift <= enddate:
+        for (d, h) in zip(dates, hours):
+            yield "%s %s\n" % (d + shift, h)
+        shift += WEEK
+
+def weeks(dates,hours,enddate):
+    """The schedule as (first day, [line]) for each week up to
+    $enddate$, without writing anything."""
+    lines = schedule(dates,hours,enddate)
+    shift = timedelta(0)
+    while dates[0] + shift <= enddate:
+        yield (dates[0] + shift, list(islice(lines, len(dates))))
+        shift += WEEK
+
 def write_files(dates,hours,enddate):
-    while dates[0] <= enddate:
-        filename = 'week_of_%s.txt' % dates[0].isoformat()
+    for (first, lines) in weeks(dates,hours,enddate):
+        filename = 'week_of_%s.txt' % first.isoformat()
         with open(filename,'w') as f:
             print filename
-            for i in range(0,7):
-                f.write("%s %s\n" % (dates[i], hours[i]))
-        dates = next_week(dates)
+            f.writelines(lines)
+
+def write_schedule(dates,hours,enddate,filename):
+    """Write the whole schedule into the one file $filename$."""
+    with open(filename,'w') as f:
+        f.writelines(schedule(dates,hours,enddate))
 
-def next_week(dates):
-    return [d + timedelta(days=7) for d in dates]
+def process_schedule(dates,hours,enddate,chart=tif.chart,out=None):
+    """Apply the schedule to the loaded $chart$ and save it, as
+    process_hours.py would with the files written by write_files."""
+    fn = "<schedule>"
+    days = process_hours.add_hours(
+        fn, process_hours.parse_hours_lines(fn, schedule(dates,hours,enddate)),
+        dict(), chart)
+    process_hours.update_hours(days, chart, out)
+    chart.save()
 
 
 if __name__=='__main__':
-    if len(sys.argv) != 3:
+    opts, args = getopt.getopt(sys.argv[1:], 'o:pc:')
+    output = None
+    process = False
+    chart = tif.chart
+    for (opt, value) in opts:
+        if opt == '-o': output = value
+        elif opt == '-p': process = True
+        elif opt == '-c': chart = tif.Ledger(value)
+    if len(args) != 2 or (output and process):
         print "%s [first week schedule.txt] [end date]" % sys.argv[0]
         print "  Outputs files with the names 'week_of_YYYY-MM-DD.txt'."
+        print "%s -o schedule.txt [first week schedule.txt] [end date]" % sys.argv[0]
+        print "  Outputs the whole schedule into one file."
+        print "%s -p [-c chart directory] [first week schedule.txt] [end date]" % sys.argv[0]
+        print "  Processes the schedule into the chart without any files."
     else:
-        our_name, proto_fn, enddate = sys.argv
+        proto_fn, enddate = args
         dates,hours = read_proto(proto_fn)
         if len(dates) != 7:
             print "This is not a weekly file, aborting"
             exit(-1)
-        write_files(dates,hours,from_iso(enddate))
+        if output:
+            write_schedule(dates,hours,from_iso(enddate),output)
+        elif process:
+            chart.load()
+            process_schedule(dates,hours,from_iso(enddate),chart)
+        else:
+            write_files(dates,hours,from_iso(enddate))
 
     
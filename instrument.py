@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# INSTRUMENTATION FOR TIFMASTER
+#
+# Opt-in timing of the phases of a run.  enable() wraps every function
+# listed in PHASES (and any further ones it is given) so that each call
+# is timed and counted; until then nothing is wrapped, so it costs
+# nothing.  Phases marked "each" write a line of JSON per call, e.g.
+#
+#   {"phase": "day", "date": "2016-03-01", "records": 8, "seconds": 0.0012}
+#
+# and finish() writes the totals of every phase that was called:
+#
+#   {"phase": "expire_lameness", "calls": 2710, "seconds": 0.081, "total": true}
+#
+# Any phase can also be run under cProfile, whose statistics finish()
+# dumps to PROFILE_FN for pstats.  Calls made while another profiled
+# phase is running are counted in that one's profile.
+
+import tif
+import cProfile
+import json
+import time
+import os
+
+PROFILE_FN = "TIF_profile_%s.prof"
+
+def records(kind):
+    """Counts the $kind$ records of every keyholder of the ledger."""
+    return lambda args, result: dict(records=sum([len(getattr(key, kind))
+                                                  for key in args[0].keyholders.itervalues()]))
+
+# (owner, function name, phase, a line per call?, describe(args, result))
+# where describe gives the counts (or other fields) for the call.
+PHASES = [
+    (tif.Ledger, 'load', 'load', True,
+     lambda args, result: dict(keyholders=len(args[0].keyholders))),
+    (tif.Ledger, 'advance_median', 'median_advance', False,
+     lambda args, result: dict(steps=args[2],
+                               vacation_credits=args[2]*len(result or []))),
+    (tif.Ledger, 'rotate_chart', 'rotation', False,
+     lambda args, result: dict(rotations=len(result))),
+    (tif.Keyholder, 'expire_lameness', 'expire_lameness', False, None),
+    (tif.Ledger, 'write_credits', 'write_credits', True, records('credits')),
+    (tif.Ledger, 'write_debits', 'write_debits', True, records('debits')),
+    (tif.Ledger, 'commit', 'commit', True, None),
+    (tif.Ledger, 'write_snapshot', 'write_snapshot', True, None),
+    ]
+
+sink = None
+pid = None     # worker processes forked from it aren't timed
+totals = dict()
+profiles = dict()
+originals = []
+profiling = [False]
+
+def emit(entry):
+    if sink is not None:
+        sink.write(json.dumps(entry, sort_keys=True) + "\n")
+
+def wrap(f,phase,each,describe,profile):
+    def timed(*args, **kwargs):
+        if os.getpid() != pid:
+            return f(*args, **kwargs)
+        profiler = None
+        if profile and not profiling[0]:
+            profiler = profiles.setdefault(phase, cProfile.Profile())
+            profiling[0] = True
+            profiler.enable()
+        start = time.time()
+        try:
+            result = f(*args, **kwargs)
+        finally:
+            seconds = time.time() - start
+            if profiler is not None:
+                profiler.disable()
+                profiling[0] = False
+        entry = describe(args, result) if describe else dict()
+        total = totals.setdefault(phase, dict(calls=0, seconds=0.0))
+        total['calls'] += 1
+        total['seconds'] += seconds
+        for (name, value) in entry.iteritems():
+            if isinstance(value, (int, long, float)):
+                total[name] = total.get(name, 0) + value
+        if each:
+            entry.update(phase=phase, seconds=seconds)
+            emit(entry)
+        return result
+    timed.__name__ = f.__name__
+    timed.__doc__ = f.__doc__
+    return timed
+
+def enable(out=None,profile=(),phases=()):
+    """Start timing PHASES and $phases$, writing to the file $out$ (if
+    any) and profiling the phases named in $profile$."""
+    global sink, pid
+    sink = out
+    pid = os.getpid()
+    totals.clear()
+    profiles.clear()
+    for (owner, name, phase, each, describe) in PHASES + list(phases):
+        if isinstance(owner, type):
+            f = owner.__dict__[name]
+        else:
+            f = getattr(owner, name)
+        originals.append((owner, name, f))
+        setattr(owner, name, wrap(f, phase, each, describe, phase in profile))
+
+def finish():
+    """Write the totals and profiles and unwrap everything."""
+    global sink
+    while originals:
+        (owner, name, f) = originals.pop()
+        setattr(owner, name, f)
+    for phase in sorted(totals):
+        entry = dict(totals[phase])
+        entry.update(phase=phase, total=True)
+        emit(entry)
+    for (phase, profiler) in profiles.iteritems():
+        profiler.dump_stats(PROFILE_FN % phase)
+    if sink is not None:
+        sink.flush()
+    sink = None
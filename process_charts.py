@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# BATCH UPDATER FOR MANY TIFMASTER CHARTS
+#
+# Each argument is a chart directory holding its own TIF_*.txt files
+# and week_of_YYYY-MM-DD.txt hours files.  The weeks starting after the
+# chart's last date of record are applied to it, as process_hours.py
+# would, with up to N charts (-j N, default 4) being processed at once.
+# Each chart's output is printed in one piece when it finishes.
+
+import tif
+import process_hours
+import sys
+import os
+import glob
+import getopt
+import traceback
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+week_re = 'week_of_*.txt'
+
+def pending_hours_files(chart):
+    """The hours files in the chart's directory for weeks starting
+    after its last date of record, in date order."""
+    fns = []
+    for fn in sorted(glob.glob(chart.path(week_re))):
+        start = os.path.basename(fn)[len('week_of_'):-len('.txt')]
+        if tif.from_iso(start) > chart.max_date():
+            fns.append(fn)
+    return fns
+
+def process_directory(directory):
+    """Bring the chart in $directory$ up to date.  Returns the output
+    and whether it succeeded."""
+    out = StringIO()
+    try:
+        chart = tif.Ledger(directory)
+        chart.load()
+        process_hours.process_chart(chart, pending_hours_files(chart),
+                                    out=out)
+        return (out.getvalue(), True)
+    except Exception:
+        traceback.print_exc(file=out)
+        return (out.getvalue(), False)
+
+def process_charts(directories, threads=4):
+    """Process the chart $directories$ on a pool of $threads$.  Returns
+    the directories that failed."""
+    pool = ThreadPool(threads)
+    failed = []
+    try:
+        for (directory, (output, ok)) in zip(directories,
+                                             pool.imap(process_directory,
+                                                       directories)):
+            print "== %s" % directory
+            print output
+            if not ok: failed.append(directory)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+if __name__=='__main__':
+    opts, directories = getopt.getopt(sys.argv[1:], 'j:')
+    threads = 4
+    for (opt, value) in opts:
+        if opt == '-j': threads = int(value)
+    if not directories:
+        print "%s [-j N] [chart directory] ..." % sys.argv[0]
+        exit(-1)
+    if process_charts(directories, threads):
+        exit(1)
@@ -10,109 +10,224 @@
 # basic info on the current database state, primarily to determine what
 # the last-processed day record was.
 #
+# Many input files can be parsed in parallel with -j N.  -i FILE appends
+# timings of each phase of the run to FILE (- for stderr) as JSON lines,
+# and -P PHASE (repeatable) profiles a phase; see instrument.py.
+#
 # Since the process of median advancement and chart rotation is a somewhat
 # irreversible procedure, it is important to process days in order rather
 # than try to insert hours later.
 
 import tif
+import instrument
 import sys
 import re
+import getopt
+import multiprocessing
 from datetime import timedelta
 
-debug = True
-
 record_re = re.compile('([A-Z]+)=?([.0-9]*)/?([.0-9]*)([a-z]*)')
 
-def read_hours_file(fn,days=dict()):
+def parse_hours_lines(fn,text):
+    """Tokenize the lines of hours file $fn$ without looking anything
+    up.  Returns a list of (line number, line, date, [(initials,
+    minutes, flags)])."""
+    lines = []
+    for (n, line) in enumerate(text, 1):
+        line = line.strip()
+        if line.startswith('$'): continue
+        if line.startswith('#'): continue
+        if len(line) < 1: continue
+        try:
+            date, rest = line.split(None,1)
+        except ValueError:
+            date = line
+            rest = ""
+        try:
+            date = tif.from_iso(date)
+        except ValueError:
+            raise Exception("%s:%d: Bad date %s." % (fn,n,date))
+        records = []
+        for record in rest.split():
+            sign = 1.0
+            if '-' in record:
+                sign = -1.0
+                record = record.replace('-','')
+            match = record_re.match(record)
+            if match is None:
+                raise Exception("%s:%d: Can't read record %s." % (fn,n,record))
+            key, hour, factor, flags = match.groups()
+            if ""==hour:
+                hour=1
+            if ""==factor:
+                factor=1
+            minutes = int(60.0*sign*float(hour)/float(factor))
+            records.append((key, minutes, flags))
+        lines.append((n, line, date, records))
+    return lines
+
+def parse_hours_file(fn):
+    """parse_hours_lines on a file, so files can be parsed in worker
+    processes."""
     with open(fn,'r') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('$'): continue
-            if line.startswith('#'): continue
-            if len(line) < 1: continue
-            if debug: print line
+        return parse_hours_lines(fn, f)
+
+def add_hours(fn,lines,days,chart=tif.chart):
+    """Check the parsed $lines$ of file $fn$ against $chart$ and add
+    them to $days$."""
+    for (n, line, date, records) in lines:
+        if date <= chart.max_date():
+            raise Exception("%s:%d: Date %s falls into previous record range." % (fn,n,date))
+        for (key, minutes, flags) in records:
             try:
-                date, rest = line.split(None,1)
-            except ValueError:
-                date = line
-                rest = ""
-            date = tif.from_iso(date)
-            if date <= tif.max_date():
-                raise Exception("Date %s falls into previous record range." % date)
-            for record in rest.split():
-                sign = 1.0
-                if '-' in record:
-                    sign = -1.0
-                    record = record.replace('-','')
-                key, hour, factor, flags = record_re.match(record).groups()
-                if ""==hour:
-                    hour=1
-                if ""==factor:
-                    factor=1
-                minutes = int(60.0*sign*float(hour)/float(factor))
-                try:
-                    key=tif.from_initials(key)                    
-                except:
-                    raise Exception("Keyholder %s not found." % key)
-                if key.active_on(date):
-                    record = dict(key=key,
-                                  minutes=timedelta(minutes=minutes),
-                                  flags=flags)
-                    if date in days:
-                        days[date].append(record)
-                    else:
-                        days[date]=[record]
+                key=chart.from_initials(key)                    
+            except KeyError:
+                raise Exception("%s:%d: Keyholder %s not found." % (fn,n,key))
+            if key.active_on(date):
+                record = dict(key=key,
+                              minutes=timedelta(minutes=minutes),
+                              flags=flags)
+                if date in days:
+                    days[date].append(record)
                 else:
-                    raise Exception("%s contains invalid keyholder %s." % (fn,key))
+                    days[date]=[record]
+            else:
+                raise Exception("%s:%d: Invalid keyholder %s." % (fn,n,key.initials))
     return days
 
-def read_hours_files(fns):
+def read_hours_file(fn,days=None,chart=tif.chart):
+    if days is None:
+        days = dict()
+    return add_hours(fn, parse_hours_file(fn), days, chart)
+
+def read_hours_files(fns,processes=1,chart=tif.chart):
+    """Read the hours files $fns$ into a dict of date to records.  With
+    $processes$ above one, the files are parsed in that many worker
+    processes; records are still added in the order of $fns$."""
+    if processes > 1 and len(fns) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            parsed = pool.map(parse_hours_file, fns)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parsed = map(parse_hours_file, fns)
     acc = dict()
-    for fn in fns:
-        acc = read_hours_file(fn,acc)
+    for (fn, lines) in zip(fns, parsed):
+        acc = add_hours(fn, lines, acc, chart)
     return acc
 
-def update_hours(days):
-    for date in days.iterkeys():
-        # New Keyholders get boosted to the median
-        for key in tif.Keyholder.keyholders.itervalues(): 
-            if key.start_date == date:
-                key.credits = tif.Keyholder.keyholders['MED'].credits
-        # And then we add the work on that day
-        for record in days[date]:
-            record['key'].add_work(tif.Credit(date,
-                                              record['minutes'],
-                                              record['flags']))
-        old = tif.last_median() # in minutes
-        new = tif.compute_median()
-        the_median = tif.from_initials(tif.MEDIAN)
-        while ((new - old) >= tif.MEDIAN_INCREMENT):
-            the_median.add_work(tif.Credit(date,
-                                           tif.MEDIAN_INCREMENT))
-            old = tif.last_median()
-            for key in tif.Keyholder.keyholders.itervalues():
-                if key.active_on(date) and key.gets_vacation(date):
-                    key.add_work(tif.Credit(date,
-                                            tif.MEDIAN_INCREMENT,
-                                            "a"))
-                    print "%s gets %d minutes of vacation credit on %r." % (key.initials, tif.MEDIAN_INCREMENT.seconds/60, date)
-        old = tif.last_median()
-        while (old >= tif.ROTATION_MAX):
-            the_median.add_lameness(tif.Credit(date,
-                                               tif.ROTATION_MAX - tif.ROTATION_MIN))
-            minmed = tif.min_median_date()
-            for key in tif.active_keys(date):
-                key.add_lameness(tif.Credit(date,
-                                            tif.ROTATION_MAX - tif.ROTATION_MIN))
-                key.expire_lameness(minmed)
-            old = tif.last_median()
-            print "Chart rotates, median moves back to %s on %s." % (tif.to_hours(tif.last_median()), date)
+def advance_median_stepwise(date, new, chart=tif.chart, out=None):
+    """Advance the median one increment at a time until it is within
+    an increment of $new$.  This is what Ledger.advance_median does in
+    bulk, and is used whenever that can't be."""
+    out = out or sys.stdout
+    the_median = chart.median()
+    old = chart.last_median()
+    while ((new - old) >= tif.MEDIAN_INCREMENT):
+        the_median.add_work(tif.Credit(date,
+                                       tif.MEDIAN_INCREMENT))
+        old = chart.last_median()
+        for key in chart.keyholders.itervalues():
+            if key.active_on(date) and key.gets_vacation(date):
+                key.add_work(tif.Credit(date,
+                                        tif.MEDIAN_INCREMENT,
+                                        "a"))
+                print >>out, "%s gets %d minutes of vacation credit on %r." % (key.initials, tif.MEDIAN_INCREMENT.seconds/60, date)
+
+def rotate_chart_stepwise(date, chart=tif.chart, out=None):
+    """Rotate the chart one rotation at a time.  Ledger.rotate_chart
+    does the same in bulk; this is kept to check it against (see
+    test_rotation.py)."""
+    out = out or sys.stdout
+    the_median = chart.median()
+    old = chart.last_median()
+    while (old >= tif.ROTATION_MAX):
+        the_median.add_lameness(tif.Credit(date,
+                                           tif.ROTATION_MAX - tif.ROTATION_MIN))
+        minmed = chart.min_median_date()
+        for key in chart.active_keys(date):
+            key.add_lameness(tif.Credit(date,
+                                        tif.ROTATION_MAX - tif.ROTATION_MIN))
+            key.expire_lameness(minmed)
+        old = chart.last_median()
+        print >>out, "Chart rotates, median moves back to %s on %s." % (tif.to_hours(chart.last_median()), date)
+
+def update_day(date, records, chart=tif.chart, out=None, median=None):
+    """Apply the $records$ of one $date$.  $median$ overrides the
+    median computed for the day, as when replaying an event.  Returns
+    the median minute totals after each chart rotation."""
+    out = out or sys.stdout
+    chart.begin_day(date)
+    # New Keyholders get boosted to the median
+    for key in chart.keyholders.itervalues(): 
+        if key.start_date == date:
+            key.set_credits([tif.Credit.from_minutes(x.date, x.mins, x.flags) for x in
+                             chart.median().credits])
+    # And then we add the work on that day
+    for record in records:
+        record['key'].add_work(tif.Credit(date,
+                                          record['minutes'],
+                                          record['flags']))
+    old = chart.last_median() # in minutes
+    new = chart.compute_median() if median is None else median
+    steps = max(0, tif.minutes(new - old)) // tif.minutes(tif.MEDIAN_INCREMENT)
+    vacationers = chart.advance_median(date, steps)
+    if vacationers is None:
+        advance_median_stepwise(date, new, chart, out)
+    for key in vacationers or []:
+        print >>out, "%s gets %d minutes of vacation credit on %r." % (key.initials, steps*tif.MEDIAN_INCREMENT.seconds/60, date)
+    totals = chart.rotate_chart(date)
+    for total in totals:
+        print >>out, "Chart rotates, median moves back to %s on %s." % (tif.to_hours(timedelta(minutes=total)), date)
+    chart.end_day(date, records, new)
+    return totals
+
+def update_hours(days, chart=tif.chart, out=None):
+    """Apply $days$, a dict of date to records, in date order.  Returns
+    the chart rotations as a list of (date, median minutes after)."""
+    rotations = []
+    for date in sorted(days.iterkeys()):
+        rotations.extend([(date, total) for total in
+                          update_day(date, days[date], chart, out)])
+    return rotations
+
+def process_chart(chart, fns, processes=1, out=None):
+    """Apply the hours files $fns$ to the loaded $chart$ and save it."""
+    out = out or sys.stdout
+    print >>out, "Median range starts at %s." % chart.min_median_date()
+    print >>out, "Last date of record is %s." % chart.max_date()
+    days = read_hours_files(fns, processes, chart)
+    update_hours(days, chart, out)
+    chart.save()
+
+# The phases of a run timed by -i and -P, besides instrument.PHASES
+PHASES = [
+    (sys.modules[__name__], 'parse_hours_lines', 'parse', False,
+     lambda args, result: dict(lines=len(result))),
+    (sys.modules[__name__], 'read_hours_files', 'read', True,
+     lambda args, result: dict(files=len(args[0]), days=len(result),
+                               records=sum([len(x) for x in result.itervalues()]))),
+    (sys.modules[__name__], 'update_day', 'day', True,
+     lambda args, result: dict(date=str(args[0]), records=len(args[1]))),
+    (sys.modules[__name__], 'advance_median_stepwise', 'median_advance_stepwise', False, None),
+    ]
 
 if __name__=='__main__':
-    tif.load()
-    print "Median range starts at %s." % tif.min_median_date()
-    print "Last date of record is %s." % tif.max_date()
-    days = read_hours_files(sys.argv[1:])
-    update_hours(days)
-    tif.write_credits()
-    tif.write_debits()
+    opts, fns = getopt.getopt(sys.argv[1:], 'j:i:P:')
+    processes = 1
+    log = None
+    profile = []
+    for (opt, value) in opts:
+        if opt == '-j': processes = int(value)
+        elif opt == '-i': log = sys.stderr if value == '-' else open(value,'a')
+        elif opt == '-P': profile.append(value)
+    if log or profile:
+        instrument.enable(log, profile, PHASES)
+    try:
+        tif.chart.load()
+        process_chart(tif.chart, fns, processes)
+    finally:
+        if log or profile:
+            instrument.finish()
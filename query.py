@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# QUERIES FOR TIFMASTER
+#
+# Answers questions about a chart's history for dashboards and the like,
+# as JSON (the default) or CSV rather than a text table:
+#
+#   query.py [-c chart directory] [-f json|csv] [-s YYYY-MM-DD] [-e YYYY-MM-DD] ...
+#       records KEY [C|D]    a keyholder's credits (C) or debits (D)
+#       balance KEY          a keyholder's balance after each change
+#       medians              the median after each day
+#       rotations            the median after each chart rotation
+#       standings [DATE]     everyone active on DATE (today) against the median
+#
+# -s and -e limit the dates to a range, inclusive.  Records come from
+# the ledger (and its archive), each keyholder's sorted by date once so
+# that a range takes a bisection to find.  Balances, medians and
+# rotations come from replaying the event log once from its first
+# checkpoint (see tif.EventLog), so they cover the days processed since.
+
+import tif
+import summary
+from tif import from_iso, minutes, MEDIAN
+from bisect import bisect_left, bisect_right
+from datetime import date
+import json
+import csv
+import sys
+import getopt
+
+class Index:
+    """Date indexes over the loaded $chart$, each built on first use."""
+    def __init__(self,chart):
+        self.chart = chart
+        self.by_key = dict() # (initials, kind) -> (dates, records, sums)
+        self.days = None     # the rest are filled in by replay()
+        self.medians = None
+        self.rotated = None  # (dates, median totals) of the rotations
+        self.balances = None # initials -> (dates, balances)
+
+    def indexed(self,initials,kind):
+        """(dates, records, sums) of keyholder $initials$'s credits (C)
+        or debits (D) in date order, sums[i] being the minutes of the
+        first i records."""
+        index = self.by_key.get((initials, kind))
+        if index is None:
+            records = sorted(self.chart.history(initials, kind),
+                             key=lambda x: x.date)
+            sums = [0]
+            for record in records:
+                sums.append(sums[-1] + record.mins)
+            index = ([x.date for x in records], records, sums)
+            self.by_key[(initials, kind)] = index
+        return index
+
+    def records(self,initials,kind='C',start=date.min,end=date.max):
+        """Keyholder $initials$'s credits (C) or debits (D) dated $start$
+        to $end$ inclusive, in date order."""
+        dates, records, sums = self.indexed(initials, kind)
+        return records[bisect_left(dates, start):bisect_right(dates, end)]
+
+    def total(self,initials,kind='C',start=date.min,end=date.max):
+        """Minutes of the records that records() would give."""
+        dates, records, sums = self.indexed(initials, kind)
+        return sums[bisect_right(dates, end)] - sums[bisect_left(dates, start)]
+
+    def replay(self):
+        """Replay the event log once, noting the median after every day,
+        the rotations and every change to a keyholder's balance."""
+        if self.days is not None: return
+        days = self.chart.events.events()
+        if not days:
+            raise Exception("%s has no events to replay." % self.chart.directory)
+        self.days = []
+        self.medians = []
+        self.rotated = ([], [])
+        self.balances = dict()
+        def each(d, ledger, totals):
+            self.days.append(d)
+            self.medians.append(ledger.median().credit_minutes)
+            self.rotated[0].extend([d]*len(totals))
+            self.rotated[1].extend(totals)
+            for key in ledger.keyholders.itervalues():
+                balance = key.credit_minutes + key.debit_minutes
+                dates, balances = self.balances.setdefault(key.initials, ([], []))
+                if not balances or balances[-1] != balance:
+                    dates.append(d)
+                    balances.append(balance)
+        self.chart.events.restore(days[-1][0], each)
+
+    def balance_at(self,initials,d):
+        """Keyholder $initials$'s balance in minutes at the end of date
+        $d$, or None before the event log begins."""
+        self.replay()
+        if initials not in self.balances: return None
+        dates, balances = self.balances[initials]
+        i = bisect_right(dates, d) - 1
+        if i < 0: return None
+        return balances[i]
+
+    def balance_changes(self,initials,start=date.min,end=date.max):
+        """[(date, minutes)] each time keyholder $initials$'s balance
+        changed from $start$ to $end$ inclusive."""
+        self.replay()
+        dates, balances = self.balances.get(initials, ([], []))
+        i, j = bisect_left(dates, start), bisect_right(dates, end)
+        return zip(dates[i:j], balances[i:j])
+
+    def median_at(self,d):
+        """The median's minutes at the end of date $d$, or None before
+        the event log begins."""
+        self.replay()
+        i = bisect_right(self.days, d) - 1
+        if i < 0: return None
+        return self.medians[i]
+
+    def median_history(self,start=date.min,end=date.max):
+        """[(date, minutes)] of the median after each day."""
+        self.replay()
+        i, j = bisect_left(self.days, start), bisect_right(self.days, end)
+        return zip(self.days[i:j], self.medians[i:j])
+
+    def rotations(self,start=date.min,end=date.max):
+        """[(date, median minutes after)] for each chart rotation."""
+        self.replay()
+        dates, totals = self.rotated
+        i, j = bisect_left(dates, start), bisect_right(dates, end)
+        return zip(dates[i:j], totals[i:j])
+
+    def standings(self,d=None):
+        """As summary.standings, in minutes, but as of the end of date
+        $d$ if given."""
+        if d is None:
+            last, rows = summary.standings(self.chart)
+            return (minutes(last), [(initials, minutes(balance))
+                                    for (initials, balance) in rows])
+        rows = [(key.initials, self.balance_at(key.initials, d))
+                for key in self.chart.active_keys(d) if key.initials != MEDIAN]
+        rows = [x for x in rows if x[1] is not None]
+        rows.sort(key=lambda (initials, balance): (-balance, initials))
+        return (self.median_at(d), rows)
+
+def write(rows,columns,fmt='json',out=None):
+    """Write $rows$, tuples in the order of $columns$, to $out$ as a JSON
+    list of objects or as CSV with a header line."""
+    out = out or sys.stdout
+    rows = [[x.isoformat() if isinstance(x, date) else x for x in row]
+            for row in rows]
+    if fmt == 'csv':
+        w = csv.writer(out)
+        w.writerow(columns)
+        w.writerows(rows)
+    else:
+        json.dump([dict(zip(columns, row)) for row in rows], out,
+                  indent=1, sort_keys=True)
+        out.write("\n")
+
+def query(index,args,start=date.min,end=date.max):
+    """Run the command line query $args$.  Returns (columns, rows)."""
+    what = args[0]
+    if what == 'records':
+        kind = args[2] if len(args) > 2 else 'C'
+        return (['initials', 'kind', 'date', 'minutes', 'flags'],
+                [(args[1], kind, x.date, x.mins, x.flags)
+                 for x in index.records(args[1], kind, start, end)])
+    elif what == 'balance':
+        return (['initials', 'date', 'minutes'],
+                [(args[1], d, m) for (d, m) in
+                 index.balance_changes(args[1], start, end)])
+    elif what == 'medians':
+        return (['date', 'minutes'], index.median_history(start, end))
+    elif what == 'rotations':
+        return (['date', 'minutes'], index.rotations(start, end))
+    elif what == 'standings':
+        last, rows = index.standings(from_iso(args[1]) if len(args) > 1 else None)
+        return (['initials', 'minutes', 'vs_median'],
+                [(initials, balance, balance - last)
+                 for (initials, balance) in rows])
+    raise KeyError(what)
+
+USAGE = """%s [-c chart directory] [-f json|csv] [-s start] [-e end] query
+  records KEY [C|D] | balance KEY | medians | rotations | standings [DATE]"""
+
+if __name__=='__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'c:f:s:e:')
+    chart = tif.chart
+    fmt = 'json'
+    start, end = date.min, date.max
+    for (opt, value) in opts:
+        if opt == '-c': chart = tif.Ledger(value)
+        elif opt == '-f': fmt = value
+        elif opt == '-s': start = from_iso(value)
+        elif opt == '-e': end = from_iso(value)
+    needs = dict(records=2, balance=2, medians=1, rotations=1, standings=1)
+    if (fmt not in ('json', 'csv') or not args or args[0] not in needs or
+        len(args) < needs[args[0]]):
+        print USAGE % sys.argv[0]
+        exit(-1)
+    chart.load()
+    columns, rows = query(Index(chart), args, start, end)
+    write(rows, columns, fmt)
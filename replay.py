@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+# VECTORIZED REPLAY FOR TIFMASTER
+#
+# Replays hours files against a chart keeping only each keyholder's
+# credit and debit totals, as NumPy arrays, so every day's work, median
+# advance and rotation is a handful of array operations however many
+# keyholders there are.  The totals come out the same as running
+# process_hours.py (lameness expiry moves minutes between debit records
+# but never changes their sum), but no records are kept and nothing is
+# written.  The constants can be overridden to see what a change to,
+# say, SURPLUS_LIMIT would have done.
+#
+#   replay.py [-c chart directory] [-k] [-s NAME=hours] ... week_of_*.txt
+#
+# -k also runs process_hours' own code on a fork of the chart and checks
+# that the totals agree.  Needs NumPy.
+
+import tif
+import process_hours
+from tif import minutes, MEDIAN
+from datetime import timedelta, date
+from StringIO import StringIO
+import sys
+import getopt
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CONSTANTS = ('MEDIAN_INCREMENT', 'ROTATION_MIN', 'ROTATION_MAX',
+             'HARD_LIMIT_TOP', 'FULL_SURPLUS', 'SURPLUS_LIMIT')
+
+class Replay:
+    """The credit and debit totals of every keyholder of $chart$,
+    starting from the loaded ones.  Any of CONSTANTS can be overridden
+    with a timedelta."""
+    def __init__(self,chart,**overrides):
+        if numpy is None:
+            raise Exception("The vectorized replay needs NumPy.")
+        self.const = dict([(name, minutes(overrides.get(name, getattr(tif, name))))
+                           for name in CONSTANTS])
+        keys = sorted(chart.keyholders.values(), key=lambda k: k.initials)
+        self.initials = [key.initials for key in keys]
+        self.index = dict([(i, n) for (n, i) in enumerate(self.initials)])
+        self.med = self.index[MEDIAN]
+        self.credit = numpy.array([key.credit_minutes for key in keys], numpy.int64)
+        self.debit = numpy.array([key.debit_minutes for key in keys], numpy.int64)
+        self.start = numpy.array([key.start_date.toordinal() for key in keys])
+        self.end = numpy.array([key.end_date.toordinal() for key in keys])
+        vacations = [(n, start.toordinal(), end.toordinal())
+                     for (n, key) in enumerate(keys)
+                     for (start, end) in key.vacations]
+        self.vacation_key = numpy.array([x[0] for x in vacations], numpy.intp)
+        self.vacation_start = numpy.array([x[1] for x in vacations])
+        self.vacation_end = numpy.array([x[2] for x in vacations])
+        self.rotations = []
+
+    def totals(self):
+        """{initials: (credit minutes, debit minutes)}"""
+        return dict([(i, (int(self.credit[n]), int(self.debit[n])))
+                     for (n, i) in enumerate(self.initials)])
+
+    def add_work(self,who,mins):
+        """Keyholder.add_work for the keyholders at indices $who$ (no
+        repeats), each getting the matching entry of $mins$."""
+        c = self.credit[who]
+        db = self.debit[who]
+        m = mins.copy()
+        newdb = db.copy()
+        debit = m < 0
+        newdb[debit] += m[debit]
+        # A credit purely making up for debit
+        behind = ~debit & (db + m < 0)
+        factor = (self.const['ROTATION_MAX'] + abs(db)) // self.const['ROTATION_MAX']
+        newdb[behind] += (m*factor)[behind]
+        rest = ~debit & ~behind
+        paying = rest & (db < 0)
+        m[paying] += db[paying]
+        newdb[paying] = 0
+        credit = rest & (m > 0)
+        # Far ahead of the median
+        full = self.const['FULL_SURPLUS']
+        over = c - self.credit[self.med]
+        fraction = 1.0 - (over - full).astype(float) / float(self.const['SURPLUS_LIMIT'] - full)
+        scaled = credit & (over > full) & (fraction > 0)
+        m[scaled] = (m*fraction).astype(numpy.int64)[scaled]
+        hard = self.const['HARD_LIMIT_TOP']
+        capped = credit & (c + m > hard)
+        m[capped] = hard - c[capped]
+        credit &= m > 0
+        self.credit[who] = c + numpy.where(credit, m, 0)
+        self.debit[who] = newdb
+
+    def add_lameness(self,who,amount):
+        """Keyholder.add_lameness of $amount$ minutes for indices $who$."""
+        covered = numpy.minimum(amount, self.credit[who])
+        self.credit[who] -= covered
+        self.debit[who] -= amount - covered
+
+    def active(self,d):
+        n = d.toordinal()
+        return (self.start <= n) & (n <= self.end)
+
+    def day(self,d,records):
+        """update_hours for the one date $d$ and its $records$, as read by
+        process_hours.read_hours_files."""
+        n = d.toordinal()
+        med = self.med
+        # New Keyholders get boosted to the median
+        self.credit[self.start == n] = self.credit[med]
+        # The work, in rounds where nobody appears twice; the median
+        # changing its own total gets a round to itself.
+        rounds = []
+        for record in records:
+            i = self.index[record['key'].initials]
+            if not rounds or i in seen or i == med or med in seen:
+                rounds.append([])
+                seen = set()
+            rounds[-1].append((i, minutes(record['minutes'])))
+            seen.add(i)
+        for r in rounds:
+            self.add_work(numpy.array([x[0] for x in r], numpy.intp),
+                          numpy.array([x[1] for x in r], numpy.int64))
+        # Median advance, a step at a time as advance_median_stepwise.
+        # Like update_hours, the median is taken over today's keyholders.
+        totals = numpy.sort(self.credit[self.active(date.today())])
+        l = len(totals)
+        target = int(totals[l//3] + totals[l//2] + totals[2*l//3])
+        inc = self.const['MEDIAN_INCREMENT']
+        on_vacation = numpy.zeros(len(self.initials), bool)
+        on_vacation[self.vacation_key[(self.vacation_start <= n) &
+                                      (n <= self.vacation_end)]] = True
+        active = self.active(d)
+        vacationers = numpy.flatnonzero(active & on_vacation)
+        one = numpy.array([med], numpy.intp)
+        while target >= 3*(self.credit[med] + inc):
+            old = self.credit[med]
+            self.add_work(one, numpy.array([inc], numpy.int64))
+            if self.credit[med] == old: break # capped; process_hours hangs
+            self.add_work(vacationers,
+                          numpy.repeat(numpy.int64(inc), len(vacationers)))
+        # Chart rotation
+        amount = self.const['ROTATION_MAX'] - self.const['ROTATION_MIN']
+        rotations = 0
+        while self.credit[med] >= self.const['ROTATION_MAX']:
+            self.add_lameness(one, amount)
+            if active[med]:
+                self.add_lameness(one, amount)
+            rotations += 1
+            self.rotations.append((d, int(self.credit[med])))
+        if rotations:
+            others = active.copy()
+            others[med] = False
+            self.add_lameness(numpy.flatnonzero(others), amount*rotations)
+
+    def run(self,days):
+        for d in sorted(days):
+            self.day(d, days[d])
+        return self
+
+def mismatches(replay,chart):
+    """The keyholders whose totals in $replay$ and $chart$ differ, as
+    (initials, replayed, actual)."""
+    totals = replay.totals()
+    return [(i, totals[i], (key.credit_minutes, key.debit_minutes))
+            for (i, key) in sorted(chart.keyholders.items())
+            if totals[i] != (key.credit_minutes, key.debit_minutes)]
+
+if __name__=='__main__':
+    opts, fns = getopt.getopt(sys.argv[1:], 'c:ks:')
+    chart = tif.chart
+    check = False
+    overrides = dict()
+    for (opt, value) in opts:
+        if opt == '-c': chart = tif.Ledger(value)
+        elif opt == '-k': check = True
+        elif opt == '-s':
+            name, hours = value.split('=')
+            if name not in CONSTANTS:
+                print "%s isn't one of %s." % (name, ', '.join(CONSTANTS))
+                exit(-1)
+            overrides[name] = timedelta(hours=float(hours))
+    chart.load()
+    days = process_hours.read_hours_files(fns, chart=chart)
+    replay = Replay(chart, **overrides).run(days)
+    for (d, total) in replay.rotations:
+        print "Chart rotates on %s, median moves back to %s." % (
+            d, tif.hours_minutes(timedelta(minutes=total)))
+    print "%10s%12s%12s" % ("Keyholder", "Credits", "Debits")
+    for (i, (credit, debit)) in sorted(replay.totals().items()):
+        print "%10s%12s%12s" % (i, tif.hours_minutes(timedelta(minutes=credit)),
+                                tif.hours_minutes(timedelta(minutes=debit)))
+    if check:
+        if overrides:
+            print "Not checking: process_hours uses the real constants."
+            exit(-1)
+        fork = chart.fork()
+        process_hours.update_hours(
+            process_hours.read_hours_files(fns, chart=fork),
+            fork, StringIO())
+        bad = mismatches(replay, fork)
+        for (i, replayed, actual) in bad:
+            print "%s: replayed %r, process_hours %r" % (i, replayed, actual)
+        if bad: exit(1)
+        print "Totals agree with process_hours."
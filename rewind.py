@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+# TIME TRAVEL FOR TIFMASTER
+#
+# Every day process_hours.py applies is logged in TIF_events.txt, with
+# a checkpoint of the whole chart every few weeks (see tif.EventLog).
+# This uses them to show the chart as it stood at the end of an earlier
+# date, or to undo the last N days processed so they can be redone.
+#
+#   rewind.py [-c chart directory] YYYY-MM-DD    standings as of that date
+#   rewind.py [-c chart directory] -u N          undo the last N days
+
+import tif
+import summary
+from tif import from_iso, hours_minutes
+import sys
+import getopt
+
+def show(chart,d):
+    """Print the summary of $chart$ as of the end of date $d$."""
+    past = chart.events.restore(d)
+    last, rows = summary.standings(past, d)
+    print "%10s%12s%14s (=%s on %s)\n" % ("Keyholder","Position","vs. Median",
+                                          hours_minutes(last), d)
+    for (initials, balance) in rows:
+        print "%10s%12s%14s" % (initials,
+                                hours_minutes(balance),
+                                hours_minutes(balance - last))
+
+if __name__=='__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'c:u:')
+    chart = tif.chart
+    undo = None
+    for (opt, value) in opts:
+        if opt == '-c': chart = tif.Ledger(value)
+        elif opt == '-u': undo = int(value)
+    if (undo is None) == (len(args) != 1):
+        print "%s [-c chart directory] YYYY-MM-DD" % sys.argv[0]
+        print "%s [-c chart directory] -u N" % sys.argv[0]
+        exit(-1)
+    chart.load()
+    if undo is None:
+        show(chart, from_iso(args[0]))
+    else:
+        print "Last date of record is now %s." % chart.events.undo(undo)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# WHAT-IF SIMULATOR FOR TIFMASTER
+#
+# Projects where everyone will stand if a schedule runs to the given end
+# date, by replaying it on a copy of the loaded chart exactly as
+# process_hours.py would.  Nothing is written to disk.
+#
+#   simulate.py [-c chart directory] [end date] [first week schedule.txt] ...
+#       each first-week schedule, extended to the end date as
+#       create_weeks.py would
+#   simulate.py [-c chart directory] week_of_YYYY-MM-DD.txt ...
+#       the given hours files as a single schedule
+#
+# The chart is loaded once and forked for every schedule, so many
+# candidates can be tried in one run, or from Python with simulate().
+
+import tif
+import process_hours
+import summary
+import create_weeks
+from tif import hours_minutes, from_iso
+from datetime import timedelta
+from StringIO import StringIO
+import sys
+import getopt
+
+def schedule_lines(proto_fn,enddate):
+    """The hours lines create_weeks.py would write for the first week
+    schedule in $proto_fn$ up to $enddate$."""
+    dates, hours = create_weeks.read_proto(proto_fn)
+    if len(dates) != 7:
+        raise ValueError("%s is not a weekly file: it has %d days, not 7"
+                         % (proto_fn, len(dates)))
+    return list(create_weeks.schedule(dates, hours, enddate))
+
+def simulate(chart,lines,fn="<schedule>"):
+    """Replay the hours $lines$ on a fork of the loaded $chart$, which is
+    left as it was.  Returns a dict of
+      medians    [(date, median minutes)] after each day
+      rotations  [(date, median minutes after)] for each chart rotation
+      standings  [(initials, balance)] on the last day, best first
+      output     what process_hours.py would have printed
+      chart      the fork, for a closer look"""
+    fork = chart.fork()
+    out = StringIO()
+    days = process_hours.add_hours(fn, process_hours.parse_hours_lines(fn, lines),
+                                   dict(), fork)
+    medians = []
+    rotations = []
+    for d in sorted(days):
+        rotations.extend([(d, total) for total in
+                          process_hours.update_day(d, days[d], fork, out)])
+        medians.append((d, fork.median().credit_minutes))
+    last, rows = summary.standings(fork, fork.max_date())
+    return dict(medians=medians, rotations=rotations, standings=rows,
+                output=out.getvalue(), chart=fork)
+
+def report(name,result):
+    print "== %s" % name
+    medians = result['medians']
+    if medians:
+        print "Median on %s is %s." % (medians[-1][0],
+                                       hours_minutes(timedelta(minutes=medians[-1][1])))
+    for (d, total) in result['rotations']:
+        print "Chart rotates on %s, median moves back to %s." % (
+            d, hours_minutes(timedelta(minutes=total)))
+    last = result['chart'].last_median()
+    print "%10s%12s%14s" % ("Keyholder","Position","vs. Median")
+    for (initials, balance) in result['standings']:
+        print "%10s%12s%14s" % (initials,
+                                hours_minutes(balance),
+                                hours_minutes(balance - last))
+    print
+
+if __name__=='__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'c:')
+    chart = tif.chart
+    for (opt, value) in opts:
+        if opt == '-c': chart = tif.Ledger(value)
+    if not args:
+        print "%s [-c chart directory] [end date] [first week schedule.txt] ..." % sys.argv[0]
+        print "%s [-c chart directory] week_of_YYYY-MM-DD.txt ..." % sys.argv[0]
+        exit(-1)
+    chart.load()
+    try:
+        enddate = from_iso(args[0])
+    except ValueError:
+        enddate = None
+    if enddate is None:
+        lines = []
+        for fn in args:
+            with open(fn,'r') as f:
+                lines.extend(f)
+        report(' '.join(args), simulate(chart, lines))
+    else:
+        try:
+            schedules = [(fn, schedule_lines(fn, enddate)) for fn in args[1:]]
+        except ValueError, e:
+            print "%s, aborting" % e
+            exit(-1)
+        for (fn, lines) in schedules:
+            report(fn, simulate(chart, lines, fn))
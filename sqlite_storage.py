@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+# SQLITE STORAGE FOR TIFMASTER
+#
+# Keeps a chart in a single TIF.sqlite database instead of the TIF_*.txt
+# files.  Records are indexed by keyholder and date, and each keyholder
+# row carries its credit and debit totals, so summaries and history
+# queries don't need the whole chart.  A chart directory holding a
+# TIF.sqlite is opened with this storage automatically.
+#
+#   sqlite_storage.py import [chart directory]   text files -> TIF.sqlite
+#   sqlite_storage.py export [chart directory]   TIF.sqlite -> text files
+#
+# Exporting leaves TIF.sqlite in place; remove it to go back to the
+# text files.
+
+import tif
+from tif import Keyholder, Credit, from_iso, MEDIAN
+from datetime import date
+from itertools import islice
+import sqlite3
+import os
+import sys
+
+schema = """
+CREATE TABLE IF NOT EXISTS keyholders (
+    initials     TEXT PRIMARY KEY,
+    start_date   TEXT NOT NULL,
+    end_date     TEXT NOT NULL,
+    credit_total INTEGER NOT NULL DEFAULT 0,
+    debit_total  INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS vacations (
+    initials   TEXT NOT NULL,
+    start_date TEXT NOT NULL,
+    end_date   TEXT NOT NULL
+);
+-- kind is C for credits and D for debits; seq keeps the ledger order,
+-- which matters as credits are consumed from the front.  Consumed rows
+-- are deleted, so a keyholder's first seq needn't be 0.
+CREATE TABLE IF NOT EXISTS records (
+    initials TEXT NOT NULL,
+    kind     TEXT NOT NULL,
+    seq      INTEGER NOT NULL,
+    date     TEXT NOT NULL,
+    minutes  INTEGER NOT NULL,
+    flags    TEXT NOT NULL,
+    PRIMARY KEY (initials, kind, seq)
+);
+CREATE INDEX IF NOT EXISTS records_by_date ON records (initials, date);
+"""
+
+class SqliteStorage:
+    """Storage for a Ledger in the SQLite database $fn$."""
+    def __init__(self,fn):
+        self.fn = fn
+        self.conn = sqlite3.connect(fn)
+        self.conn.executescript(schema)
+        self.partial = False
+
+    def load(self,ledger,snapshot=True,records=True,only=None):
+        for (initials, start, end, credit_total, debit_total) in \
+                self.conn.execute("SELECT initials, start_date, end_date, "
+                                  "credit_total, debit_total FROM keyholders"):
+            key = Keyholder(str(initials), from_iso(start), from_iso(end),
+                            ledger)
+            key.credit_minutes = credit_total
+            key.debit_minutes = debit_total
+        for (initials, start, end) in self.conn.execute(
+                "SELECT initials, start_date, end_date FROM vacations"):
+            ledger.keyholders[initials].add_vacation(from_iso(start),
+                                                     from_iso(end))
+        self.partial = not records
+        if records:
+            for (initials, kind, d, minutes, flags) in self.conn.execute(
+                    "SELECT initials, kind, date, minutes, flags FROM records "
+                    "ORDER BY initials, kind, seq"):
+                key = ledger.keyholders[initials]
+                record = Credit.from_minutes(from_iso(d), minutes, str(flags))
+                if kind == 'C':
+                    key.credits.append(record)
+                else:
+                    key.debits.append(record)
+            for key in ledger.keyholders.itervalues():
+                key.credit_minutes = sum([x.mins for x in key.credits])
+                key.debit_minutes = sum([x.mins for x in key.debits])
+                key.synced_credits = len(key.credits)
+                key.synced_debits = len(key.debits)
+        (lo, hi) = self.conn.execute(
+            "SELECT MIN(date), MAX(date) FROM records").fetchone()
+        if lo is not None:
+            ledger.record_dates.add(from_iso(lo))
+            ledger.record_dates.add(from_iso(hi))
+        ledger.median_index.invalidate()
+
+    def end_day(self,ledger,d):
+        ledger.save()
+
+    def save(self,ledger):
+        """Write the changes since the last load or save as one
+        transaction."""
+        if self.partial:
+            raise Exception("%s was loaded without its records." % self.fn)
+        with self.conn:
+            for key in ledger.keyholders.itervalues():
+                touched = False
+                for (kind, records, synced) in (('C', key.credits, key.synced_credits),
+                                                ('D', key.debits, key.synced_debits)):
+                    consumed = None
+                    if kind == 'C' and synced is not None:
+                        consumed = key.consumed_credits
+                    if (consumed is None and synced is not None and
+                        synced >= len(records)): continue
+                    first = self.conn.execute(
+                        "SELECT MIN(seq) FROM records WHERE initials=? AND kind=?",
+                        (key.initials, kind)).fetchone()[0] or 0
+                    if consumed is not None:
+                        first += consumed
+                        self.conn.execute("DELETE FROM records WHERE initials=? "
+                                          "AND kind=? AND seq<?",
+                                          (key.initials, kind, first))
+                        if synced:
+                            self.conn.execute("UPDATE records SET minutes=? "
+                                              "WHERE initials=? AND kind=? "
+                                              "AND seq=?",
+                                              (records[0].mins, key.initials,
+                                               kind, first))
+                    keep = synced or 0
+                    self.conn.execute("DELETE FROM records WHERE initials=? "
+                                      "AND kind=? AND seq>=?",
+                                      (key.initials, kind, first+keep))
+                    self.conn.executemany(
+                        "INSERT INTO records VALUES (?,?,?,?,?,?)",
+                        [(key.initials, kind, first+keep+i, x.date.isoformat(),
+                          x.mins, x.flags)
+                         for (i, x) in enumerate(islice(records, keep, None))])
+                    touched = True
+                if touched:
+                    self.conn.execute("UPDATE keyholders SET credit_total=?, "
+                                      "debit_total=? WHERE initials=?",
+                                      (key.credit_minutes, key.debit_minutes,
+                                       key.initials))
+        # only once committed, so a failed save can be retried
+        for key in ledger.keyholders.itervalues():
+            key.synced_credits = len(key.credits)
+            key.synced_debits = len(key.debits)
+            key.consumed_credits = None
+
+    def history(self,ledger,initials,kind,start,end):
+        return [Credit.from_minutes(from_iso(d), minutes, str(flags))
+                for (d, minutes, flags) in self.conn.execute(
+                    "SELECT date, minutes, flags FROM records WHERE "
+                    "initials=? AND kind=? AND date BETWEEN ? AND ? "
+                    "ORDER BY seq",
+                    (initials, kind, start.isoformat(), end.isoformat()))]
+
+    def replace_all(self,ledger):
+        """Overwrite the whole database with $ledger$."""
+        with self.conn:
+            for table in ('keyholders', 'vacations', 'records'):
+                self.conn.execute("DELETE FROM %s" % table)
+            for key in ledger.keyholders.itervalues():
+                self.conn.execute("INSERT INTO keyholders VALUES (?,?,?,?,?)",
+                                  (key.initials, key.start_date.isoformat(),
+                                   key.end_date.isoformat(),
+                                   key.credit_minutes, key.debit_minutes))
+                self.conn.executemany("INSERT INTO vacations VALUES (?,?,?)",
+                                      [(key.initials, start.isoformat(),
+                                        end.isoformat())
+                                       for (start, end) in key.vacations])
+                for (kind, records) in (('C', key.credits), ('D', key.debits)):
+                    self.conn.executemany(
+                        "INSERT INTO records VALUES (?,?,?,?,?,?)",
+                        [(key.initials, kind, i, x.date.isoformat(),
+                          x.mins, x.flags) for (i, x) in enumerate(records)])
+                key.synced_credits = len(key.credits)
+                key.synced_debits = len(key.debits)
+                key.consumed_credits = None
+
+def import_text(directory):
+    """Copy the text chart in $directory$ into its TIF.sqlite."""
+    ledger = tif.Ledger(directory, tif.TextStorage())
+    ledger.load(snapshot=False)
+    SqliteStorage(ledger.path(tif.SQLITE_FN)).replace_all(ledger)
+
+def export_text(directory):
+    """Write the chart in $directory$'s TIF.sqlite out as text files."""
+    ledger = tif.Ledger(directory,
+                        SqliteStorage(os.path.join(directory, tif.SQLITE_FN)))
+    ledger.load()
+    keys = ledger.keyholders.items()
+    keys.sort()
+    with open(ledger.path(tif.KEYHOLDERS_FN),'w') as f:
+        for (name, key) in keys:
+            if name == MEDIAN: continue
+            if key.end_date != date.max:
+                f.write("%s %s %s\n" % (name, key.start_date, key.end_date))
+            elif key.start_date != date.min:
+                f.write("%s %s\n" % (name, key.start_date))
+            else:
+                f.write("%s\n" % name)
+    with open(ledger.path(tif.VACATIONS_FN),'w') as f:
+        for (name, key) in keys:
+            for (start, end) in key.vacations:
+                f.write("%s %s %s\n" % (name, start, end))
+    # compact() writes credits and debits whole and empties the journal
+    ledger.compact()
+    if os.path.exists(ledger.path(tif.SNAPSHOT_FN)):
+        os.remove(ledger.path(tif.SNAPSHOT_FN))
+
+if __name__=='__main__':
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ('import', 'export'):
+        print "%s import|export [chart directory]" % sys.argv[0]
+        exit(-1)
+    directory = sys.argv[2] if len(sys.argv) == 3 else '.'
+    if sys.argv[1] == 'import':
+        import_text(directory)
+    else:
+        export_text(directory)
@@ -3,25 +3,39 @@
 # QUICK SUMMARY GENERATOR FOR TIFMASTER
 #
 # This prints a list of keyholders and how much ahead or behind of the
-# median they are as of the current state of the TIF database.
+# median they are as of the current state of the TIF database.  Give a
+# chart directory to summarize that instead of the current one.
 
-from tif import Keyholder, load, active_keys, last_median, minutes, hours_minutes, MEDIAN
+import tif
+from tif import minutes, hours_minutes, MEDIAN
 from datetime import date
+import sys
 
-def summary():
-    load()
-    active_keyholders = active_keys(date.today()) # was max
-    active_keyholders.sort(
-        lambda a,b: minutes(b.current_balance() - a.current_balance()))
-    last = last_median()
+def standings(chart,d=None):
+    """The loaded chart's median and its keyholders active on $d$
+    (today by default), other than the median, with their balances,
+    best first."""
+    active_keyholders = chart.active_keys(d or date.today()) # was max
+    # best first, ties by name
+    active_keyholders.sort(key=lambda k: (-minutes(k.current_balance()),
+                                          k.initials))
+    return (chart.last_median(),
+            [(key.initials, key.current_balance())
+             for key in active_keyholders if key.initials != MEDIAN])
+
+def summary(chart=tif.chart):
+    chart.load(records=False, only=lambda key: key.active())
+    last, rows = standings(chart)
     print "%10s%12s%14s (=%s)\n" % ("Keyholder","Position","vs. Median",
                                     (hours_minutes(last)))
-    for key in active_keyholders:
-        if key.initials==MEDIAN: continue
-        print "%10s%12s%14s" % (key.initials,
-                                hours_minutes(key.current_balance()),
-                                hours_minutes(key.current_balance() - last))
+    for (initials, balance) in rows:
+        print "%10s%12s%14s" % (initials,
+                                hours_minutes(balance),
+                                hours_minutes(balance - last))
     
 
 if __name__=='__main__':
-    summary()
+    if len(sys.argv) > 1:
+        summary(tif.Ledger(sys.argv[1]))
+    else:
+        summary()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# SYNTHETIC CHART GENERATOR FOR TIFMASTER
+#
+# Makes up a chart of the given size in a directory: keyholders (some
+# joining or leaving along the way), vacations, and hours for every day.
+# The first $years$ of hours are processed into the credit and debit
+# files just as process_hours.py would; the following $weeks$ are left
+# as week_of_YYYY-MM-DD.txt files waiting to be processed.
+#
+#   synthetic.py [-k keyholders] [-y years of history] [-w weeks pending]
+#                [-v vacations per keyholder per year] [-d debit rate]
+#                [-p records per day] [-s seed] directory
+
+import tif
+import process_hours
+from tif import MEDIAN
+from datetime import date, timedelta
+import random
+import string
+import sys
+import os
+import getopt
+
+START = date(2015,1,5) # a Monday, as create_weeks.py expects
+
+# Command line flags for generate()'s options
+OPTIONS = dict(k=('keyholders', int), y=('years', float), w=('weeks', int),
+               v=('vacations', float), d=('debit_rate', float),
+               p=('per_day', int), s=('seed', int))
+
+def initials(n,rand):
+    """$n$ distinct sets of initials, as short as will comfortably fit."""
+    length = 2
+    while 26**length < 4*n:
+        length += 1
+    names = set()
+    while len(names) < n:
+        name = ''.join(rand.choice(string.ascii_uppercase) for i in range(length))
+        if name != MEDIAN:
+            names.add(name)
+    return sorted(names)
+
+def record(name,debit_rate,rand):
+    r = rand.random()
+    if r < debit_rate: return '-' + name
+    r = rand.random()
+    if r < 0.2: return '%s=%d' % (name, rand.randint(2,4))
+    if r < 0.3: return '%s=3/2x' % name
+    return name
+
+def generate(directory,keyholders=30,years=1,weeks=4,vacations=1.0,
+             debit_rate=0.1,per_day=None,seed=1):
+    """Write a synthetic chart into $directory$ (made if need be).
+    $per_day$ defaults to a fifth of the keyholders."""
+    rand = random.Random(seed)
+    if per_day is None:
+        per_day = max(1, keyholders//5)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    history = 7*int(round(years*52)) # whole weeks, so pending ones start on Mondays
+    end = START + timedelta(days=history + 7*weeks - 1)
+    span = (end - START).days
+    names = initials(keyholders, rand)
+    ranges = dict()
+    with open(os.path.join(directory, tif.KEYHOLDERS_FN),'w') as f:
+        for (i, name) in enumerate(names):
+            r = rand.random()
+            if i >= 3 and r < 0.1:
+                last = START + timedelta(days=rand.randint(0, span))
+                f.write("%s %s %s\n" % (name, START, last))
+                ranges[name] = (START, last)
+            elif i >= 3 and r < 0.2:
+                first = START + timedelta(days=rand.randint(1, span))
+                f.write("%s %s\n" % (name, first))
+                ranges[name] = (first, date.max)
+            else:
+                f.write("%s\n" % name)
+                ranges[name] = (date.min, date.max)
+    with open(os.path.join(directory, tif.VACATIONS_FN),'w') as f:
+        for name in names:
+            for i in range(int(vacations*span/365.25 + rand.random())):
+                first = START + timedelta(days=rand.randint(0, span))
+                f.write("%s %s %s\n" % (name, first,
+                                        first + timedelta(days=rand.randint(2,20))))
+    for fn in (tif.CREDITS_FN, tif.DEBITS_FN):
+        open(os.path.join(directory, fn),'w').close()
+    days = []
+    for n in range(span + 1):
+        d = START + timedelta(days=n)
+        active = [x for x in names if ranges[x][0] <= d <= ranges[x][1]]
+        chosen = rand.sample(active, min(per_day, len(active)))
+        days.append("%s %s\n" % (d, ' '.join(record(x, debit_rate, rand)
+                                              for x in chosen)))
+    if history:
+        chart = tif.Ledger(directory, tif.TextStorage())
+        chart.load(snapshot=False)
+        with open(os.devnull,'w') as out:
+            parsed = process_hours.parse_hours_lines("<history>", days[:history])
+            process_hours.update_hours(
+                process_hours.add_hours("<history>", parsed, dict(), chart),
+                chart, out)
+        chart.compact()
+    for n in range(history, len(days), 7):
+        fn = 'week_of_%s.txt' % (START + timedelta(days=n))
+        with open(os.path.join(directory, fn),'w') as f:
+            f.writelines(days[n:n+7])
+
+if __name__=='__main__':
+    opts, args = getopt.getopt(sys.argv[1:], ':'.join(OPTIONS) + ':')
+    if len(args) != 1:
+        print "%s [-k keyholders] [-y years] [-w weeks] [-v vacations] [-d debit rate] [-p records per day] [-s seed] directory" % sys.argv[0]
+        exit(-1)
+    options = dict()
+    for (opt, value) in opts:
+        name, kind = OPTIONS[opt[1]]
+        options[name] = kind(value)
+    generate(args[0], **options)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# ROTATION EQUIVALENCE TEST FOR TIFMASTER
+#
+# Ledger.rotate_chart does in bulk what process_hours.py's
+# rotate_chart_stepwise does a rotation at a time.  This runs both on
+# forks of synthetic charts (see synthetic.py) pushed into rotating, and
+# checks they leave the same records and totals and report the same
+# rotations, including the cases where add_rotations falls back to the
+# stepwise loop.
+#
+#   python -m unittest test_rotation
+
+import tif
+import process_hours
+import synthetic
+from tif import Credit, minutes, MEDIAN
+from datetime import timedelta
+from StringIO import StringIO
+import unittest
+import tempfile
+import shutil
+import random
+
+ROTATION = minutes(tif.ROTATION_MAX - tif.ROTATION_MIN)
+
+def state(chart):
+    return sorted([(key.initials, key.credit_minutes, key.debit_minutes,
+                    [(x.date, x.mins, x.flags) for x in key.credits],
+                    [(x.date, x.mins, x.flags) for x in key.debits])
+                   for key in chart.keyholders.itervalues()])
+
+def bulk(chart,d):
+    """Ledger.rotate_chart, reporting as update_day does."""
+    out = StringIO()
+    for total in chart.rotate_chart(d):
+        print >>out, "Chart rotates, median moves back to %s on %s." % (
+            tif.to_hours(timedelta(minutes=total)), d)
+    return out.getvalue()
+
+def stepwise(chart,d):
+    out = StringIO()
+    process_hours.rotate_chart_stepwise(d, chart, out)
+    return out.getvalue()
+
+class RotationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='tif_test_')
+        self.expired = []
+        self.expire_lameness = tif.Keyholder.expire_lameness
+        def counted(key, d):
+            self.expired.append(key.initials)
+            return self.expire_lameness(key, d)
+        tif.Keyholder.expire_lameness = counted
+
+    def tearDown(self):
+        tif.Keyholder.expire_lameness = self.expire_lameness
+        shutil.rmtree(self.directory)
+
+    def chart(self,seed):
+        directory = '%s/%d' % (self.directory, seed)
+        synthetic.generate(directory, keyholders=15, years=0.3, weeks=0,
+                           seed=seed)
+        chart = tif.Ledger(directory, tif.TextStorage())
+        chart.load(snapshot=False)
+        return chart
+
+    def push(self,chart,d,rotations):
+        """Give the median enough credit dated $d$ to rotate
+        $rotations$ times."""
+        the_median = chart.median()
+        need = minutes(tif.ROTATION_MAX) + (rotations-1)*ROTATION
+        if the_median.credit_minutes < need:
+            the_median.add_work(Credit.from_minutes(
+                d, need - the_median.credit_minutes), the_median.credit_minutes)
+
+    def compare(self,chart,d):
+        """Rotate forks of $chart$ both ways on $d$.  Returns the number
+        of rotations and of expire_lameness calls the bulk rotation
+        made, which is one per rotation for a keyholder falling back to
+        the stepwise loop but one in all otherwise."""
+        a, b = chart.fork(), chart.fork()
+        del self.expired[:]
+        printed = bulk(a, d)
+        expired = len(self.expired)
+        self.assertEqual(printed, stepwise(b, d))
+        self.assertTrue(printed)
+        self.assertEqual(state(a), state(b))
+        self.assertEqual(a.min_median_date(), b.min_median_date())
+        return (len(printed.splitlines()), expired)
+
+    def test_generated(self):
+        for seed in range(1, 21):
+            chart = self.chart(seed)
+            rand = random.Random(seed)
+            d = chart.max_date() + timedelta(days=1)
+            self.push(chart, d, rand.randint(1, 4))
+            # some keyholders run out of credit part way, taking black marks
+            for key in rand.sample(chart.active_keys(d), 5):
+                if key.initials == MEDIAN: continue
+                short = rand.randint(1, 3*ROTATION)
+                key.set_credits([Credit.from_minutes(d - timedelta(days=1), short)])
+                key.credit_minutes = short
+            chart.median_index.invalidate()
+            self.compare(chart, d)
+
+    def test_unordered_debits(self):
+        chart = self.chart(21)
+        d = chart.max_date() + timedelta(days=1)
+        self.push(chart, d, 3)
+        keys = [x for x in chart.active_keys(d) if x.initials != MEDIAN]
+        for key in keys:
+            # expirable debits, older than any credit, out of date order
+            key.debits.extend([Credit.from_minutes(d - timedelta(days=1000), -60),
+                               Credit.from_minutes(d - timedelta(days=2000), -60)])
+            key.debit_minutes -= 120
+        rotations, expired = self.compare(chart, d)
+        self.assertTrue(rotations >= 2)
+        self.assertTrue(expired >= rotations*len(keys))
+
+    def test_black_marks_before_expiry(self):
+        chart = self.chart(22)
+        d = chart.max_date() + timedelta(days=1)
+        # The median's credits all come after $d$, so the black marks
+        # made on $d$ could be expired by a later rotation.
+        the_median = chart.median()
+        the_median.set_credits([Credit.from_minutes(d + timedelta(days=5),
+                                                    minutes(tif.ROTATION_MAX) +
+                                                    2*ROTATION)])
+        the_median.credit_minutes = minutes(tif.ROTATION_MAX) + 2*ROTATION
+        chart.median_index.invalidate()
+        for key in chart.active_keys(d):
+            if key.initials != MEDIAN:
+                key.set_credits([])
+                key.credit_minutes = 0
+        chart.median_index.invalidate()
+        keys = len(chart.active_keys(d)) - 1
+        rotations, expired = self.compare(chart, d)
+        self.assertTrue(rotations >= 2)
+        self.assertTrue(expired >= rotations*keys)
+
+if __name__=='__main__':
+    unittest.main()
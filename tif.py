@@ -1,13 +1,30 @@
 #!/usr/bin/env python
 
 from datetime import timedelta, date
-import re, math
+import re, math, os, glob
+import cPickle, hashlib, gzip
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from itertools import islice
 
 ## Constants
 KEYHOLDERS_FN    = "TIF_keyholders.txt"
 VACATIONS_FN     = "TIF_vacations.txt"
 CREDITS_FN       = "TIF_credits.txt"
 DEBITS_FN        = "TIF_debits.txt"
+JOURNAL_FN       = "TIF_journal.txt"
+JOURNAL_LIMIT    = 0.5 # compact once the journal is this fraction of
+                       # the credit and debit files' size,
+JOURNAL_MIN      = 16*1024 # or this many bytes if that is more
+SNAPSHOT_FN      = "TIF_snapshot.pickle"
+SNAPSHOT_VERSION = 3
+SQLITE_FN        = "TIF.sqlite"
+ARCHIVE_FN       = "TIF_archive.txt.gz"
+EVENTS_FN        = "TIF_events.txt"
+CHECKPOINT_FN    = "TIF_checkpoint_%s.pickle" # %s is the date
+CHECKPOINT_DAYS  = 28 # days of events between checkpoints
+SUMMARY_FLAG     = "S" # a record standing for archived ones; hours
+                       # records only take lowercase flags
 MEDIAN           = "MED"
 MEDIAN_INCREMENT = timedelta(hours=1)
 ROTATION_MIN     = timedelta(hours=39)
@@ -20,143 +37,406 @@ verbose = False
 
 zero_t = timedelta(minutes=0)
 
-class Keyholder:
-    keyholders=dict()
-    def __init__(self,initials,start_date,end_date):
+class Keyholder(object):
+    # Set while the record lists are shared with a fork (see
+    # Ledger.fork); the first change copies them.
+    shared = False
+    def __init__(self,initials,start_date,end_date,ledger=None):
+        if ledger is None:
+            ledger = chart
+        self.ledger = ledger
         self.initials = initials
         self.start_date = start_date
         self.end_date = end_date
-        self.vacations = []
-        self.credits = []
+        self.vacations = []        # merged (start, end) dates, sorted
+        self.vacation_starts = []  # the starts alone, for bisecting
+        self.credit_dates = None   # cached (min, max) of the credit dates
+        self.credits = deque() # consumed from the front by add_lameness
         self.debits = []
-        self.credit_total = zero_t
-        self.debit_total = zero_t
-        Keyholder.keyholders[initials] = self 
+        self.credit_minutes = 0
+        self.debit_minutes = 0
+        # Number of leading records known to be on disk unchanged, or
+        # None if the whole list has to be rewritten.
+        self.synced_credits = 0
+        self.synced_debits = 0
+        # Credits taken off the front of those on disk since: the number
+        # dropped, or None if none were and the first wasn't cut down.
+        self.consumed_credits = None
+        ledger.keyholders[initials] = self 
+        ledger.median_index.invalidate()
+    def __getstate__(self):
+        # The ledger is reattached by whoever unpickles us.
+        state = self.__dict__.copy()
+        del state['ledger']
+        state.pop('shared', None)
+        return state
+    def fork(self,ledger):
+        """A copy of this keyholder in $ledger$ sharing the records
+        until either side changes them."""
+        key = Keyholder.__new__(Keyholder)
+        key.__dict__.update(self.__dict__)
+        key.ledger = ledger
+        self.shared = key.shared = True
+        ledger.keyholders[key.initials] = key
+        return key
+    def unshare(self):
+        """Take private copies of the records before changing them."""
+        if not self.shared: return
+        self.credits = deque([Credit.from_minutes(x.date, x.mins, x.flags)
+                              for x in self.credits])
+        self.debits = [Credit.from_minutes(x.date, x.mins, x.flags)
+                       for x in self.debits]
+        self.vacations = list(self.vacations)
+        self.vacation_starts = list(self.vacation_starts)
+        self.shared = False
     def gets_vacation(self,d):
         """Checks whether this keyholder should get vacation credit
         for a Median advance on the date $d$.  Takes the two-week
         delay into account."""
-        for (start,end) in self.vacations:
-            if (start <= d.isoformat()) and (d.isoformat() <= end):
-                return True
-        return False
+        i = bisect_right(self.vacation_starts, d) - 1
+        return i >= 0 and d <= self.vacations[i][1]
+    def add_vacation(self,start,end):
+        """Add the vacation from $start$ to $end$ inclusive, merging it
+        with any overlapping or adjacent ones."""
+        self.unshare()
+        i = bisect_left(self.vacation_starts, start)
+        if i > 0 and self.vacations[i-1][1] + timedelta(days=1) >= start:
+            i -= 1
+            start = self.vacations[i][0]
+        j = i
+        while (j < len(self.vacations) and
+               self.vacations[j][0] <= end + timedelta(days=1)):
+            end = max(end, self.vacations[j][1])
+            j += 1
+        self.vacations[i:j] = [(start,end)]
+        self.vacation_starts[i:j] = [start]
     def active_on(self,d):
         return (self.start_date <= d) and (d <= self.end_date)
     def active(self):
         return self.active_on(date.today())
+    # Totals are kept in integer minutes; these are the timedelta views.
+    @property
+    def credit_total(self):
+        return timedelta(minutes=self.credit_minutes)
+    @property
+    def debit_total(self):
+        return timedelta(minutes=self.debit_minutes)
     def current_balance(self):
-        return self.credit_total + self.debit_total
-    def add_work(self, credit):
-        """Register work, adjusting debits and credits as appropriate"""
-        if credit.time < zero_t:            
+        return timedelta(minutes=self.credit_minutes + self.debit_minutes)
+    def add_work(self, credit, median=None):
+        """Register work, adjusting debits and credits as appropriate.
+        $median$ overrides the median's total in minutes, for callers
+        replaying several median advances at once."""
+        self.unshare()
+        if credit.mins < 0:            
             # Keyholder received a debit
             self.debits.append(credit)
-            self.debit_total += credit.time
+            self.debit_minutes += credit.mins
+            self.ledger.record_dates.add(credit.date)
             return
-        elif self.debit_total + credit.time < zero_t: 
+        elif self.debit_minutes + credit.mins < 0: 
             # A credit purely making up for debit
-            credit.adjust_for_behindness(self.debit_total)
+            credit.adjust_for_behindness(self.debit_minutes)
             self.debits.append(credit)
-            self.debit_total += credit.time
+            self.debit_minutes += credit.mins
+            self.ledger.record_dates.add(credit.date)
             return
-        if self.debit_total < zero_t:
-            self.debits.append(Credit(credit.date,
-                                  -1*self.debit_total,
-                                  credit.flags))
-            credit.time += self.debit_total
-            self.debit_total = zero_t
-            if credit.time <= zero_t: return
+        if self.debit_minutes < 0:
+            self.debits.append(Credit.from_minutes(credit.date,
+                                                   -self.debit_minutes,
+                                                   credit.flags))
+            self.ledger.record_dates.add(credit.date)
+            credit.mins += self.debit_minutes
+            self.debit_minutes = 0
+            if credit.mins <= 0: return
         # adjust minutes if far ahead of the median
-        median = last_median()
-        if self.credit_total-median > FULL_SURPLUS: 
-            fraction = 1.0 - (float(minutes(self.credit_total-median-FULL_SURPLUS)) /
-                              float(minutes(SURPLUS_LIMIT-FULL_SURPLUS)))
+        if median is None:
+            median = self.ledger.median().credit_minutes
+        full_surplus = minutes(FULL_SURPLUS)
+        if self.credit_minutes-median > full_surplus: 
+            fraction = 1.0 - (float(self.credit_minutes-median-full_surplus) /
+                              float(minutes(SURPLUS_LIMIT)-full_surplus))
             if fraction > 0:
-                credit.set_minutes(int(credit.minutes()*fraction))
-        if self.credit_total+credit.time > HARD_LIMIT_TOP:
-            credit.time = HARD_LIMIT_TOP-self.credit_total
-        if credit.minutes() <= 0: return
+                credit.mins = int(credit.mins*fraction)
+        hard_limit = minutes(HARD_LIMIT_TOP)
+        if self.credit_minutes+credit.mins > hard_limit:
+            credit.mins = hard_limit-self.credit_minutes
+        if credit.mins <= 0: return
         self.credits.append(credit)
-        self.credit_total += credit.time
+        old_total = self.credit_minutes
+        self.credit_minutes += credit.mins
+        self.ledger.median_index.moved(self, old_total)
+        self.ledger.record_dates.add(credit.date)
+        if self.credit_dates is not None:
+            (lo, hi) = self.credit_dates
+            self.credit_dates = (min(lo, credit.date), max(hi, credit.date))
+    def add_increments(self, d, n, flags, median):
+        """Same as $n$ calls to add_work with a MEDIAN_INCREMENT credit
+        on date $d$, where the median stands at $median$ minutes plus
+        one increment more before each call.  When none of the credits
+        would be reduced or capped, they are added in one go."""
+        if n <= 0: return
+        self.unshare()
+        inc = minutes(MEDIAN_INCREMENT)
+        if (self.debit_minutes < 0 or
+            self.credit_minutes - (median + inc) > minutes(FULL_SURPLUS) or
+            self.credit_minutes + n*inc > minutes(HARD_LIMIT_TOP)):
+            for k in xrange(n):
+                self.add_work(Credit.from_minutes(d, inc, flags),
+                              median + (k+1)*inc)
+            return
+        self.credits.extend([Credit.from_minutes(d, inc, flags)
+                             for k in xrange(n)])
+        old_total = self.credit_minutes
+        self.credit_minutes += n*inc
+        self.ledger.median_index.moved(self, old_total)
+        self.ledger.record_dates.add(d)
+        if self.credit_dates is not None:
+            (lo, hi) = self.credit_dates
+            self.credit_dates = (min(lo, d), max(hi, d))
     def add_lameness(self, debit):
         """Register a missed session, removing existing credits as
         appropriate, then adding debits as the median advances."""
-        while debit.minutes() > 0:
+        self.unshare()
+        old_total = self.credit_minutes
+        while debit.mins > 0:
             if len(self.credits) > 0:
                 record = self.credits[0]
-                if record.time > debit.time:
+                if record.mins > debit.mins:
                     # subtract some time from a credit in place
-                    record.time -= debit.time
-                    self.credit_total -= debit.time
-                    debit.set_minutes(0)
+                    record.mins -= debit.mins
+                    self.credit_minutes -= debit.mins
+                    debit.mins = 0
+                    self.consume_credits(0)
                 else:
                     # consume a credit entirely
-                    debit.time -= record.time
-                    self.credit_total -= record.time
-                    self.credits = self.credits[1:]
+                    debit.mins -= record.mins
+                    self.credit_minutes -= record.mins
+                    self.credits.popleft()
+                    self.credit_dates = None
+                    self.consume_credits(1)
             else:
                 # no credits, add a Black Mark
-                self.debits.append(Credit(debit.date,
-                                      -debit.time,
-                                      'a')) # a)uto
-                self.debit_total -= debit.time
-                debit.time -=debit.time
+                self.debits.append(Credit.from_minutes(debit.date,
+                                                       -debit.mins,
+                                                       'a')) # a)uto
+                self.ledger.record_dates.add(debit.date)
+                self.debit_minutes -= debit.mins
+                debit.mins = 0
+        self.ledger.median_index.moved(self, old_total)
+    def consume_credits(self,n):
+        """Note that $n$ credits were dropped from the front and the
+        next cut down, so the journal can say just that.  Only credits
+        already on disk count."""
+        if not self.synced_credits: return
+        self.synced_credits -= n
+        self.consumed_credits = (self.consumed_credits or 0) + n
+    def add_rotations(self, d, amount, minmeds):
+        """Same as, for each date $m$ in $minmeds$, calling add_lameness
+        with $amount$ minutes on date $d$ and then expire_lameness($m$),
+        as update_hours does once per chart rotation.  Done as a single
+        pass over the credits and one expire_lameness when the black
+        marks can't be expired by later rotations and the expirable
+        debits are in date order, which is the usual case."""
+        if not minmeds: return
+        self.unshare()
+        last = minmeds[-1]
+        ordered = d >= last
+        previous = date.min
+        for record in self.debits:
+            if not ordered: break
+            if record.mins <= 0 and record.date < last:
+                ordered = record.date >= previous
+                previous = record.date
+        if not ordered:
+            for m in minmeds:
+                self.add_lameness(Credit.from_minutes(d, amount))
+                self.expire_lameness(m)
+            return
+        total = amount*len(minmeds)
+        covered = min(total, max(0, self.credit_minutes))
+        self.add_lameness(Credit.from_minutes(d, covered))
+        # one Black Mark for each rotation the credits ran out in
+        for i in xrange(1, len(minmeds)+1):
+            short = min(amount, i*amount - covered)
+            if short > 0:
+                self.debits.append(Credit.from_minutes(d, -short, 'a'))
+                self.debit_minutes -= short
+                self.ledger.record_dates.add(d)
+        self.expire_lameness(last)
+    def credit_date_range(self):
+        """Earliest and latest date among the current credits.  Cached
+        until a credit is consumed or the credits are replaced."""
+        if self.credit_dates is None:
+            lo, hi = date.max, date.min
+            for record in self.credits:
+                if record.date < lo: lo = record.date
+                if record.date > hi: hi = record.date
+            self.credit_dates = (lo, hi)
+        return self.credit_dates
+    def set_credits(self,records):
+        """Replace the credits wholesale, e.g. when boosting a new
+        keyholder to the median."""
+        self.unshare()
+        self.credits = deque(records)
+        self.credit_dates = None
+        self.synced_credits = None
+        old_total = self.credit_minutes
+        self.credit_minutes = sum([record.mins for record in self.credits])
+        self.ledger.median_index.moved(self, old_total)
     def expire_lameness(self,d):
         """Remove any cancelling debit-credit pairs before date $d$"""
+        # Debits (non-positive records) before $d$ are "old" and end up
+        # ahead of the rest.  The first pass finds out whether there is
+        # anything to cancel or reorder at all, which is rare.
         total=0
-        newdebits=[]
-        olddebits=[]
+        ordered=True
+        seen_new=False
         for record in self.debits:
-            if record.minutes() > 0:
-                newdebits.append(record)
-                total += record.minutes()
-            elif record.date >= d:
-                newdebits.append(record)
+            if record.mins <= 0 and record.date < d:
+                if seen_new: ordered = False
             else:
-                olddebits.append(record)
+                seen_new = True
+                if record.mins > 0:
+                    total += record.mins
+        if total == 0 and ordered: return
+        self.unshare()
+        old = [(record, record.mins) for record in self.debits]
         anti_minutes = total
-        self.debits = []
-        for record in olddebits:
+        changed = not ordered
+        kept = []
+        for record in self.debits:
+            if record.mins > 0 or record.date >= d: continue
             if total > 0:
-                if -(record.minutes()) <= total:
-                    total += record.minutes()
+                changed = True
+                if -(record.mins) <= total:
+                    total += record.mins
                 else:
-                    record.add_minutes(total)
+                    record.mins += total
                     total = 0
-                    self.debits.append(record)
+                    kept.append(record)
             else:
-                self.debits.append(record)
-        for record in newdebits:
-            if record.minutes() > 0 and total < anti_minutes: 
-                if record.minutes() <= (anti_minutes - total):
-                    total += record.minutes()
+                kept.append(record)
+        for record in self.debits:
+            if record.mins <= 0 and record.date < d: continue
+            if record.mins > 0 and total < anti_minutes: 
+                changed = True
+                if record.mins <= (anti_minutes - total):
+                    total += record.mins
                 else:
-                    record.add_minutes(total-anti_minutes)
-                    self.debits.append(record)
+                    record.mins += total-anti_minutes
+                    kept.append(record)
                     total = anti_minutes
             else: 
-                self.debits.append(record)
+                kept.append(record)
+        self.debits[:] = kept
+        if changed and self.synced_debits is not None:
+            # only the debits from the first changed one need writing
+            i = 0
+            while (i < len(kept) and i < self.synced_debits and
+                   kept[i] is old[i][0] and kept[i].mins == old[i][1]):
+                i += 1
+            if i == len(kept) and i < len(old):
+                # Only the end went, which leaves nothing to append;
+                # rewrite the last debit kept so there is a line to
+                # cut the rest off with.
+                i = i - 1 if i else None
+            self.synced_debits = i
 
 
-def from_initials(i):
-    return Keyholder.keyholders[i]
+class MedianIndex:
+    """The credit totals of the keyholders active on one date, kept
+    sorted so compute_median can read off its quantiles directly.
+    Moving to another date only looks at the keyholders starting or
+    ending in between."""
+    def __init__(self,ledger):
+        self.ledger = ledger
+        self.date = None
+    def invalidate(self):
+        self.date = None
+    def rebuild(self,d):
+        keys = self.ledger.keyholders.values()
+        starts = sorted([(x.start_date, x.initials) for x in keys])
+        ends = sorted([(x.end_date, x.initials) for x in keys])
+        self.start_dates = [x[0] for x in starts]
+        self.start_keys = [x[1] for x in starts]
+        self.end_dates = [x[0] for x in ends]
+        self.end_keys = [x[1] for x in ends]
+        self.members = set([x.initials for x in keys if x.active_on(d)])
+        self.totals = sorted([(self.ledger.keyholders[i].credit_minutes, i)
+                              for i in self.members])
+        self.date = d
+    def move_to(self,d):
+        if self.date is None:
+            self.rebuild(d)
+            return
+        if d == self.date: return
+        lo, hi = min(d, self.date), max(d, self.date)
+        changed = set()
+        for (dates, keys) in ((self.start_dates, self.start_keys),
+                              (self.end_dates, self.end_keys)):
+            changed.update(keys[bisect_left(dates, lo):bisect_right(dates, hi)])
+        self.date = d
+        for i in changed:
+            key = self.ledger.keyholders[i]
+            if key.active_on(d) and i not in self.members:
+                self.members.add(i)
+                insort(self.totals, (key.credit_minutes, i))
+            elif not key.active_on(d) and i in self.members:
+                self.members.remove(i)
+                del self.totals[bisect_left(self.totals, (key.credit_minutes, i))]
+    def moved(self,key,old_total):
+        """Called whenever $key$'s credit total changes from $old_total$
+        minutes."""
+        if self.date is None or key.initials not in self.members: return
+        if old_total == key.credit_minutes: return
+        del self.totals[bisect_left(self.totals, (old_total, key.initials))]
+        insort(self.totals, (key.credit_minutes, key.initials))
 
-class Credit:
+class DateSpan:
+    """The earliest and latest dates ever recorded in the ledger."""
+    def __init__(self):
+        self.reset()
+    def reset(self):
+        self.lo = date.max
+        self.hi = date.min
+    def add(self,d):
+        if d < self.lo: self.lo = d
+        if d > self.hi: self.hi = d
+
+class Credit(object):
+    """One ledger record.  The amount is kept as whole minutes in
+    $mins$; $time$ is the timedelta view of it."""
+    __slots__ = ('date', 'mins', 'flags')
     def __init__(self,date, time, flags=""):
         self.date = date
-        self.time = time
+        self.mins = minutes(time)
         self.flags = flags
+    @classmethod
+    def from_minutes(cls,date,mins,flags=""):
+        record = cls.__new__(cls)
+        record.date = date
+        record.mins = mins
+        record.flags = flags
+        return record
+    @property
+    def time(self):
+        return timedelta(minutes=self.mins)
+    @time.setter
+    def time(self,t):
+        self.mins = minutes(t)
     def minutes(self):        
-        return minutes(self.time)
+        return self.mins
     def set_minutes(self,m):
-        self.time = timedelta(minutes=m)
+        self.mins = m
     def add_minutes(self,m):
-        self.time += timedelta(minutes=m)
+        self.mins += m
     def adjust_for_behindness(self,debt):
-        median_time = (24*60*60 * ROTATION_MAX.days + ROTATION_MAX.seconds)
-        debt_time = abs(24*60*60 * debt.days + debt.seconds)
+        """$debt$ is the (negative) debit total in minutes."""
+        median_time = minutes(ROTATION_MAX)
+        debt_time = abs(debt)
         factor = (median_time + debt_time)//median_time
-        self.time *= factor
+        self.mins *= factor
         
 
 
@@ -182,176 +462,888 @@ class FormatError(Exception):
     def __str__(self):
         return repr(self.value)
 
-def load_keyholders(fn=KEYHOLDERS_FN):
-    keys=[]
-    with open(fn,'r') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('#'): continue
-            if len(line.split()) == 3:
-                key, start, end = line.split()
-                start_yr, start_mn, start_dy = start.split('-')
-                end_yr, end_mn, end_dy = end.split('-')
-                if verbose:
-                    print ("Creating date %s-%s-%s" % 
-                           (start_yr,start_mn,start_dy))
-                start = date(int(start_yr),int(start_mn),int(start_dy))
-                end = date(int(end_yr),int(end_mn),int(end_dy))
-            elif len(line.split()) == 2:
-                key, start = line.split()
-                start_yr, start_mn, start_dy = start.split('-')
-                start = date(int(start_yr),int(start_mn),int(start_dy))
-                end = date.max
-            elif len(line.split()) == 1:
-                key = line.split()[0]
-                start = date.min
-                end = date.max
-            else:
-                raise FormatError()
-            if verbose:
-                print "Read keyholder %s from %s to %s" % (key,
-                                                           start.isoformat(),
-                                                           end.isoformat())
-            keys.append(Keyholder(key,start,end))
-    keys.append(Keyholder(MEDIAN,date.min,date.max))
-    return keys
-
-def load_vacations(fn=VACATIONS_FN):
-    with open(fn,'r') as f:
-        for line in f:
-            line=line.strip();
-            if line.startswith('#'): continue
-            key,start,end = line.split()
-            try:
-                Keyholder.keyholders[key].vacations.append((start,end))
-            except KeyError:
-                print ("Read vacation for non-keyholder %s." % key)
-                raise
-
 def from_iso(s):
     """Takes YYYY-MM-DD to a date object"""
     (yr,mo,dy)=s.split('-')
     return date(int(yr),int(mo),int(dy))
 
-credit_re = re.compile('(.*)=(\d+)([a-z]*)')
-
-def load_credits(fn=CREDITS_FN):
-    with open(fn,'r') as f:
-        for line in f:
-            line=line.strip()
-            if line=="": continue
-            if line.startswith('#'): continue
-            records = line.split()
-            key = records[0]
-            for record in records[1:]:
-                date, minutes, flags = credit_re.match(record).groups()
+FLAG_LETTERS = 'abcdefghijklmnopqrstuvwxyz' + SUMMARY_FLAG
+debit_re = re.compile('(.*)=(-?\d+)([a-z%s]*)' % SUMMARY_FLAG)
+
+def format_records(records):
+    return ''.join([' %s=%s%s' % (record.date,
+                                  record.mins,
+                                  record.flags)
+                    for record in records])
+
+def file_digest(fn):
+    h = hashlib.md5()
+    with open(fn,'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_signature(fn):
+    """(size, mtime, md5) of $fn$, or None if it doesn't exist."""
+    if not os.path.exists(fn): return None
+    st = os.stat(fn)
+    return (st.st_size, st.st_mtime, file_digest(fn))
+
+def snapshot_fresh(signatures):
+    """Whether the files still match $signatures$.  A changed mtime
+    alone is let off if the contents hash the same."""
+    for (fn, sig) in signatures:
+        if sig is None or not os.path.exists(fn):
+            if sig is not None or os.path.exists(fn): return False
+            continue
+        st = os.stat(fn)
+        if st.st_size != sig[0]: return False
+        if st.st_mtime != sig[1] and file_digest(fn) != sig[2]: return False
+    return True
+
+class TextStorage:
+    """Keeps a chart in the TIF_*.txt files of its directory, with the
+    journal and snapshot described below.  The storage interface is
+    load, end_day (after each day update_hours processes), save and
+    history; see sqlite_storage.py for the other implementation."""
+    partial = False
+    def load(self,ledger,snapshot=True,records=True,only=None):
+        self.partial = ledger.load_text(snapshot, only)
+    def end_day(self,ledger,d):
+        pass # the whole run goes into one journal block
+    def save(self,ledger):
+        if self.partial:
+            raise Exception("%s was loaded with only some keyholders."
+                            % ledger.directory)
+        ledger.commit()
+        ledger.write_snapshot()
+    def history(self,ledger,initials,kind,start,end):
+        key = ledger.keyholders[initials]
+        records = key.credits if kind == 'C' else key.debits
+        return [x for x in records if start <= x.date <= end]
+
+class ScratchStorage(TextStorage):
+    """For a forked Ledger: everything stays in memory."""
+    def load(self,ledger,snapshot=True,records=True,only=None):
+        raise Exception("A forked chart can't be loaded.")
+    def save(self,ledger):
+        pass
+
+def open_storage(directory):
+    """SQLite if the directory has a database, else the text files."""
+    if os.path.exists(os.path.join(directory, SQLITE_FN)):
+        import sqlite_storage
+        return sqlite_storage.SqliteStorage(os.path.join(directory, SQLITE_FN))
+    return TextStorage()
+
+class EventLog:
+    """Every day processed into a ledger, kept in EVENTS_FN as a line
+
+      YYYY-MM-DD MEDIAN KEY=minutes[flags] ...
+
+    giving the day's records and the median update_day aimed for (which
+    depends on when it ran), along with pickled checkpoints of the whole
+    ledger every CHECKPOINT_DAYS.  Any earlier state can then be had by
+    replaying the events since the checkpoint before it.  If a day is
+    logged again, say after a crash or undo, the later line wins."""
+    def __init__(self,ledger):
+        self.ledger = ledger
+        self.pending = []
+        self.baseline = None # (date, fork) of the state before the first event
+        self.checkpointed = None
+    def checkpoints(self):
+        """[(date, filename)] of the checkpoints, oldest first."""
+        prefix, suffix = CHECKPOINT_FN.split('%s')
+        return sorted([(from_iso(os.path.basename(fn)[len(prefix):-len(suffix)]), fn)
+                       for fn in glob.glob(self.ledger.path(CHECKPOINT_FN % '*'))])
+    def begin_day(self,d):
+        if self.checkpointed is None:
+            self.checkpointed = bool(self.checkpoints())
+        if not self.checkpointed and self.baseline is None:
+            # Nothing to replay from yet, so keep the state as it was
+            self.baseline = (d - timedelta(days=1), self.ledger.fork())
+    def end_day(self,d,records,median):
+        self.pending.append('%s %d%s\n' % (d, minutes(median), ''.join(
+            [' %s=%d%s' % (r['key'].initials, minutes(r['minutes']), r['flags'])
+             for r in records])))
+    def flush(self):
+        """Write the pending events, before the ledger itself is saved."""
+        if self.baseline is not None:
+            self.write_checkpoint(*self.baseline)
+            self.baseline = None
+        if self.pending:
+            with open(self.ledger.path(EVENTS_FN),'a') as f:
+                f.write(''.join(self.pending))
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending = []
+    def checkpoint(self):
+        """Checkpoint the saved ledger if the last checkpoint is
+        CHECKPOINT_DAYS old."""
+        cps = self.checkpoints()
+        d = self.ledger.max_date()
+        if cps and d - cps[-1][0] >= timedelta(days=CHECKPOINT_DAYS):
+            self.write_checkpoint(d, self.ledger)
+    def write_checkpoint(self,d,ledger):
+        fn = self.ledger.path(CHECKPOINT_FN % d)
+        state = dict(version=SNAPSHOT_VERSION, date=d,
+                     keyholders=ledger.keyholders,
+                     record_dates=ledger.record_dates)
+        with open(fn + '.tmp','wb') as f:
+            cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(fn + '.tmp', fn)
+        self.checkpointed = True
+    def events(self):
+        """[(date, median minutes, [(initials, minutes, flags)])]"""
+        events = []
+        fn = self.ledger.path(EVENTS_FN)
+        if not os.path.exists(fn): return events
+        with open(fn,'r') as f:
+            for line in f:
+                if not line.endswith("\n"): break # torn by a crash
+                fields = line.split()
+                d = from_iso(fields[0])
+                while events and events[-1][0] >= d:
+                    events.pop()
+                events.append((d, int(fields[1]),
+                               [(i, int(m), flags) for (i, m, flags) in
+                                [debit_re.match(x).groups() for x in fields[2:]]]))
+        return events
+    def restore(self,d,each=None):
+        """A scratch Ledger of the chart as it was at the end of date $d$.
+        Keyholders' dates and vacations are taken as they are now.  With
+        $each$, replays from the first checkpoint instead of the last,
+        calling $each$(day, ledger, rotations) with the checkpoint and
+        then after every day, rotations being the median totals
+        update_day returned."""
+        import process_hours
+        cps = [x for x in self.checkpoints() if x[0] <= d]
+        if not cps:
+            raise Exception("There is no checkpoint from %s or before." % d)
+        (start, fn) = cps[0] if each else cps[-1]
+        with open(fn,'rb') as f:
+            state = cPickle.load(f)
+        ledger = Ledger(self.ledger.directory, ScratchStorage())
+        ledger.events = None
+        for key in state['keyholders'].itervalues():
+            key.ledger = ledger
+        ledger.keyholders.update(state['keyholders'])
+        ledger.record_dates = state['record_dates']
+        for key in self.ledger.keyholders.itervalues():
+            if key.initials not in ledger.keyholders:
+                Keyholder(key.initials, key.start_date, key.end_date, ledger)
+            old = ledger.keyholders[key.initials]
+            old.start_date, old.end_date = key.start_date, key.end_date
+            old.vacations = list(key.vacations)
+            old.vacation_starts = list(key.vacation_starts)
+        ledger.median_index.invalidate()
+        if each: each(start, ledger, [])
+        with open(os.devnull,'w') as out:
+            for (day, median, records) in self.events():
+                if not start < day <= d: continue
+                totals = process_hours.update_day(
+                    day, [dict(key=ledger.keyholders[i],
+                               minutes=timedelta(minutes=m), flags=flags)
+                          for (i, m, flags) in records],
+                    ledger, out, timedelta(minutes=median))
+                if each: each(day, ledger, totals)
+        return ledger
+    def undo(self,n):
+        """Put the ledger back as it was before its last $n$ days and save
+        it.  Returns the date it now runs to."""
+        days = [x[0] for x in self.events() if x[0] <= self.ledger.max_date()]
+        if n <= 0: return self.ledger.max_date()
+        if n < len(days):
+            d = days[-n-1]
+        elif n == len(days) and self.checkpoints():
+            d = self.checkpoints()[0][0]
+        else:
+            raise Exception("Only %d days can be undone." % len(days))
+        restored = self.restore(d)
+        # Later checkpoints go first; a crash after that only leaves
+        # fewer to replay from.
+        for (day, fn) in self.checkpoints():
+            if day > d: os.remove(fn)
+        self.ledger.keyholders.clear()
+        for key in restored.keyholders.itervalues():
+            key.ledger = self.ledger
+            key.shared = False
+            key.synced_credits = key.synced_debits = None
+        self.ledger.keyholders.update(restored.keyholders)
+        self.ledger.record_dates = restored.record_dates
+        self.ledger.median_index.invalidate()
+        self.ledger.storage.save(self.ledger)
+        if isinstance(self.ledger.storage, TextStorage):
+            # The undone records would still count towards max_date
+            # from the old ledger files, whatever the journal says.
+            self.ledger.compact()
+            self.ledger.write_snapshot()
+        fn = self.ledger.path(EVENTS_FN)
+        with open(fn + '.tmp','w') as f:
+            f.writelines(['%s %d%s\n' % (day, median, ''.join(
+                [' %s=%d%s' % x for x in records]))
+                          for (day, median, records) in self.events() if day <= d])
+        os.rename(fn + '.tmp', fn)
+        return d
+
+class Ledger(object):
+    """One chart: its keyholders, the median and the files they are
+    kept in, all under $directory$.  Independent charts can be loaded
+    and processed side by side."""
+    def __init__(self,directory='.',storage=None):
+        self.directory = directory
+        self.storage = storage or open_storage(directory)
+        self.keyholders = dict()
+        self.median_index = MedianIndex(self)
+        self.record_dates = DateSpan()
+        self.journal_offset = None
+        self.journal_stale = False # see replay_journal
+        self.archive = None # {(kind, initials): [records]} once read
+        self.events = EventLog(self)
+    def path(self,fn):
+        return os.path.join(self.directory, fn)
+    def from_initials(self,i):
+        return self.keyholders[i]
+    def median(self):
+        return self.keyholders[MEDIAN]
+
+    def load_keyholders(self,fn=None):
+        fn = fn or self.path(KEYHOLDERS_FN)
+        keys=[]
+        with open(fn,'r') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('#'): continue
+                if len(line.split()) == 3:
+                    key, start, end = line.split()
+                    start_yr, start_mn, start_dy = start.split('-')
+                    end_yr, end_mn, end_dy = end.split('-')
+                    if verbose:
+                        print ("Creating date %s-%s-%s" % 
+                               (start_yr,start_mn,start_dy))
+                    start = date(int(start_yr),int(start_mn),int(start_dy))
+                    end = date(int(end_yr),int(end_mn),int(end_dy))
+                elif len(line.split()) == 2:
+                    key, start = line.split()
+                    start_yr, start_mn, start_dy = start.split('-')
+                    start = date(int(start_yr),int(start_mn),int(start_dy))
+                    end = date.max
+                elif len(line.split()) == 1:
+                    key = line.split()[0]
+                    start = date.min
+                    end = date.max
+                else:
+                    raise FormatError()
+                if verbose:
+                    print "Read keyholder %s from %s to %s" % (key,
+                                                               start.isoformat(),
+                                                               end.isoformat())
+                keys.append(Keyholder(key,start,end,self))
+        keys.append(Keyholder(MEDIAN,date.min,date.max,self))
+        return keys
+
+    def load_vacations(self,fn=None,only=None):
+        fn = fn or self.path(VACATIONS_FN)
+        with open(fn,'r') as f:
+            for line in f:
+                line=line.strip();
+                if line.startswith('#'): continue
+                key,start,end = line.split()
+                if only is not None and key not in only: continue
                 try:
-                    #if key==MEDIAN: continue
-                    Keyholder.keyholders[key].credits.append(
-                        Credit(from_iso(date),
-                               timedelta(minutes=int(minutes)),
-                               flags))
+                    self.keyholders[key].add_vacation(from_iso(start),
+                                                      from_iso(end))
                 except KeyError:
-                    print ("Read credit for non-keyholder %s." % key)
-                    exit(1)
-        for key in Keyholder.keyholders.values():
-            key.credit_total=zero_t
-            for record in key.credits:
-                key.credit_total += record.time
-
-debit_re = re.compile('(.*)=(-?\d+)([a-z]*)')
-
-def load_debits(fn=DEBITS_FN):
-    with open(fn,'r') as f:
-        for line in f:
-            line=line.strip();
-            if line=="": continue
-            if line.startswith('#'): continue
-            records = line.split()
-            key = records[0]
-            for record in records[1:]:
-                date, minutes, flags = debit_re.match(record).groups()
+                    print ("Read vacation for non-keyholder %s." % key)
+                    raise
+
+    def load_records(self,fn,kind,only=None):
+        """Read the credits (C) or debits (D) file $fn$ in one pass,
+        totalling as it goes.  With $only$, a set of initials, the
+        other keyholders' lines are skipped unparsed.  Returns
+        {initials: minutes} for the keyholders read."""
+        totals = dict()
+        dates = dict() # each date string is parsed once
+        new = Credit.__new__
+        with open(fn,'r', 1<<20) as f:
+            for line in f:
+                head = line.split(None, 1)
+                if not head or head[0].startswith('#'): continue
+                name = head[0]
+                if only is not None and name not in only: continue
+                records = line.split()
                 try:
-                    Keyholder.keyholders[key].debits.append(
-                        Credit(from_iso(date),
-                               timedelta(minutes=int(minutes)),
-                               flags))
+                    key = self.keyholders[name]
                 except KeyError:
-                    print ("Read debit for non-keyholder %s." % key)
+                    print ("Read %s for non-keyholder %s." %
+                           ('credit' if kind == 'C' else 'debit', name))
                     exit(1)
-        for key in Keyholder.keyholders.values():
-            key.debit_total=zero_t
-            for debit in key.debits:
-                key.debit_total += debit.time
-            if (key.debit_total > zero_t):
+                total = 0
+                parsed = []
+                for record in records[1:]:
+                    # date=minutes[flags]
+                    d, sep, rest = record.partition('=')
+                    m = rest.rstrip(FLAG_LETTERS)
+                    x = new(Credit)
+                    x.date = dates.get(d)
+                    if x.date is None:
+                        x.date = dates[d] = from_iso(d)
+                        self.record_dates.add(x.date)
+                    x.mins = int(m)
+                    x.flags = rest[len(m):]
+                    total += x.mins
+                    parsed.append(x)
+                if kind == 'C':
+                    key.credits.extend(parsed)
+                else:
+                    key.debits.extend(parsed)
+                totals[name] = totals.get(name, 0) + total
+        return totals
+
+    def load_credits(self,fn=None,only=None):
+        totals = self.load_records(fn or self.path(CREDITS_FN), 'C', only)
+        for key in self.keyholders.itervalues():
+            key.credit_minutes = totals.get(key.initials, 0)
+            key.synced_credits = len(key.credits)
+        self.median_index.invalidate()
+
+    def load_debits(self,fn=None,only=None):
+        totals = self.load_records(fn or self.path(DEBITS_FN), 'D', only)
+        for key in self.keyholders.itervalues():
+            key.debit_minutes = totals.get(key.initials, 0)
+            key.synced_debits = len(key.debits)
+            if (key.debit_minutes > 0):
                 print "Warning: keyholder %s has positive debits." \
                     % key.initials
 
-def write_activity(filename,f):
-    with open(filename,'w') as fl:
-        keys = Keyholder.keyholders.items()
+    def write_activity(self,filename,f):
+        """Rewrite a whole ledger file.  The new contents go to a
+        temporary file which is renamed over the old one, so a crash
+        leaves either the old or the new file, never half of one."""
+        tmp = filename + '.tmp'
+        with open(tmp,'w') as fl:
+            keys = self.keyholders.items()
+            keys.sort()
+            for (name,key) in keys:
+                fl.write(key.initials)
+                if verbose: print "Writing keyholder %s." % key.initials
+                fl.write(format_records(f(key)))
+                fl.write("\n\n")
+            fl.flush()
+            os.fsync(fl.fileno())
+        os.rename(tmp, filename)
+                      
+    def write_credits(self,fn=None):
+        self.write_activity(fn or self.path(CREDITS_FN), lambda x: x.credits)
+        for key in self.keyholders.values():
+            key.synced_credits = len(key.credits)
+            key.consumed_credits = None
+
+    def write_debits(self,fn=None):
+        self.write_activity(fn or self.path(DEBITS_FN), lambda x: x.debits)
+        for key in self.keyholders.values():
+            key.synced_debits = len(key.debits)
+
+    ## Journal
+    #
+    # Rather than rewriting the credit and debit files after every run,
+    # changes are appended to a journal.  Each line is
+    #
+    #   C|D KEY KEEP date=minutes[flags] ...
+    #
+    # meaning "keep the first KEEP credits (C) or debits (D) of keyholder
+    # KEY and then append the given records", so rewriting a keyholder is
+    # just KEEP=0, or
+    #
+    #   F KEY N [M]
+    #
+    # meaning "drop the first N credits of KEY and cut the next down to M
+    # minutes", which is all a chart rotation does to most keyholders.
+    # A block of lines only counts once it is followed by a "." line;
+    # anything after the last "." was torn by a crash and is ignored (and
+    # truncated on the next commit).
+    #
+    # F lines can't be applied twice, so the journal starts with
+    #
+    #   # base CREDITS-MD5 DEBITS-MD5
+    #
+    # naming the files it applies to.  A file that no longer matches was
+    # rewritten by a compact() that was cut short before emptying the
+    # journal, and already has its part of the journal folded in.
+
+    def journal_header(self):
+        return "# base %s %s\n" % (file_digest(self.path(CREDITS_FN)),
+                                   file_digest(self.path(DEBITS_FN)))
+
+    def replay_journal(self,fn=None,only=None):
+        """Apply committed journal blocks on top of the loaded ledger,
+        for just the keyholders in $only$ if given."""
+        fn = fn or self.path(JOURNAL_FN)
+        self.journal_offset = 0
+        self.journal_stale = False
+        if not os.path.exists(fn): return
+        touched = set()
+        pending = []
+        folded = set() # kinds whose file has the journal in already
+        based = False
+        with open(fn,'r') as f:
+            offset = 0
+            for line in f:
+                offset += len(line)
+                if not line.endswith("\n"): break
+                line = line.strip()
+                if line.startswith("#"):
+                    fields = line.split()
+                    if fields[1:2] == ['base']:
+                        if file_digest(self.path(CREDITS_FN)) != fields[2]:
+                            folded.update(['C', 'F'])
+                        if file_digest(self.path(DEBITS_FN)) != fields[3]:
+                            folded.add('D')
+                        based = True
+                        self.journal_offset = offset
+                elif line == ".":
+                    for (kind, key, keep, records) in pending:
+                        try:
+                            key = self.keyholders[key]
+                        except KeyError:
+                            print ("Read journal for non-keyholder %s." % key)
+                            exit(1)
+                        if kind == 'C':
+                            key.credits = deque(islice(key.credits, keep))
+                            key.credits.extend(records)
+                            key.credit_dates = None
+                        elif kind == 'F':
+                            key.credits = deque(islice(key.credits, keep, None))
+                            if records is not None:
+                                key.credits[0].mins = records
+                            key.credit_dates = None
+                        else:
+                            key.debits = key.debits[:keep] + records
+                        touched.add(key)
+                    pending = []
+                    self.journal_offset = offset
+                elif line != "":
+                    fields = line.split()
+                    if fields[0] in folded: continue
+                    if only is not None and fields[1] not in only: continue
+                    if fields[0] == 'F':
+                        pending.append(('F', fields[1], int(fields[2]),
+                                        int(fields[3]) if len(fields) > 3 else None))
+                        continue
+                    records = []
+                    for record in fields[3:]:
+                        d, m, flags = debit_re.match(record).groups()
+                        records.append(Credit.from_minutes(from_iso(d), int(m),
+                                                           flags))
+                    pending.append((fields[0], fields[1], int(fields[2]), records))
+        # A journal without a header can't take F lines safely.
+        self.journal_stale = bool(folded) or (self.journal_offset > 0 and
+                                              not based)
+        for key in touched:
+            key.credit_minutes = 0
+            for record in key.credits:
+                key.credit_minutes += record.mins
+                self.record_dates.add(record.date)
+            key.debit_minutes = 0
+            for record in key.debits:
+                key.debit_minutes += record.mins
+                self.record_dates.add(record.date)
+            key.synced_credits = len(key.credits)
+            key.synced_debits = len(key.debits)
+        self.median_index.invalidate()
+
+    def commit(self,fn=None):
+        """Append every change since the last load or commit to the journal
+        as one block, compacting into the ledger files when it gets big."""
+        fn = fn or self.path(JOURNAL_FN)
+        if self.journal_stale:
+            # finish the compaction that was cut short
+            self.compact(fn)
+        lines = []
+        keys = self.keyholders.items()
         keys.sort()
         for (name,key) in keys:
-            fl.write(key.initials)
-            if verbose: print "Writing keyholder %s." % key.initials
-            for record in f(key):
-                fl.write(' %s=%s%s' % (record.date,
-                                       record.minutes(),
-                                       record.flags))
-            fl.write("\n\n")
-                      
-def write_credits(fn=CREDITS_FN):
-    write_activity(fn, lambda x: x.credits)
-
-def write_debits(fn=DEBITS_FN):
-    write_activity(fn, lambda x: x.debits)
-
-def active_keys(d):
-    return [x for x in Keyholder.keyholders.values() if x.active_on(d)]
-
-def min_median_date():
-    m = date.max
-    for record in Keyholder.keyholders[MEDIAN].credits:
-        if record.date < m:
-            m = record.date
-    return m
-
-def max_median_date():
-    m = date.min
-    for record in Keyholder.keyholders[MEDIAN].credits:
-        if record.date > m:
-            m = record.date
-    return m
-
-def max_date():
-    m = date.min
-    for key in Keyholder.keyholders.values():
-        for record in (key.credits + key.debits):
-            if record.date > m: 
-                m = record.date
-    return m
-
-def last_median():
-    """Minutes total for the median last record (i.e., not freshly computed)"""
-    return Keyholder.keyholders[MEDIAN].credit_total
-
-def compute_median():
-    """Computes the median for the list of current keyholders.  To make
-the median advance a little more gradually, it's given as the mean of
-the keyholders at the 1/3, 1/2, and 2/3 level."""
-    totals = [] #totals = [x.credit_total for x in Keyholder.keyholders.itervalues()]
-    for x, y in Keyholder.keyholders.items():
-        if y.active():
-            totals.append(y.credit_total)
-    totals.sort()
-    l = len(totals)
-    return (totals[l//3] + totals[l//2] + totals[2*l//3])//3
-
-def load():
-    load_keyholders()
-    load_vacations()
-    load_credits()
-    load_debits()
+            if key.consumed_credits is not None and key.synced_credits is not None:
+                lines.append('F %s %d%s\n' % (key.initials, key.consumed_credits,
+                                              ' %d' % key.credits[0].mins
+                                              if key.synced_credits else ''))
+            for (kind, records, synced) in (('C', key.credits, key.synced_credits),
+                                            ('D', key.debits, key.synced_debits)):
+                if synced is not None and synced >= len(records): continue
+                keep = synced or 0
+                lines.append('%s %s %d%s\n' % (kind, key.initials, keep,
+                                               format_records(islice(records, keep, None))))
+        if lines:
+            with open(fn,'a') as f:
+                if self.journal_offset is not None:
+                    f.truncate(self.journal_offset)
+                f.seek(0, os.SEEK_END)
+                if f.tell() == 0:
+                    f.write(self.journal_header())
+                f.write(''.join(lines) + ".\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_offset = os.path.getsize(fn)
+        # only now that the block is down, so a failed commit can be retried
+        for key in self.keyholders.itervalues():
+            key.synced_credits = len(key.credits)
+            key.synced_debits = len(key.debits)
+            key.consumed_credits = None
+        ledger_size = sum([os.path.getsize(x) for x in
+                           (self.path(CREDITS_FN), self.path(DEBITS_FN))
+                           if os.path.exists(x)])
+        if (os.path.exists(fn) and
+            os.path.getsize(fn) > max(JOURNAL_MIN, JOURNAL_LIMIT*ledger_size)):
+            self.compact(fn)
+
+    def compact(self,fn=None):
+        """Fold the journal back into the credit and debit files."""
+        fn = fn or self.path(JOURNAL_FN)
+        self.write_credits()
+        self.write_debits()
+        header = self.journal_header()
+        with open(fn,'w') as f:
+            f.write(header)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_offset = len(header)
+        self.journal_stale = False
+
+    def active_keys(self,d):
+        return [x for x in self.keyholders.values() if x.active_on(d)]
+
+    def min_median_date(self):
+        return self.median().credit_date_range()[0]
+
+    def max_median_date(self):
+        return self.median().credit_date_range()[1]
+
+    def min_date(self):
+        """Earliest date of any record loaded or added since."""
+        return self.record_dates.lo
+
+    def max_date(self):
+        """Latest date of any record loaded or added since.  Records later
+        consumed by a chart rotation still count, as their day has been
+        processed."""
+        return self.record_dates.hi
+
+    def last_median(self):
+        """Minutes total for the median last record (i.e., not freshly computed)"""
+        return self.median().credit_total
+
+    def advance_median(self, d, n):
+        """Advance the median by $n$ increments on date $d$, giving every
+        keyholder on vacation a credit per increment.  Returns the
+        keyholders given vacation credit, or None if this can't be done in
+        bulk (the median would be capped or is itself on vacation), in
+        which case nothing has been changed."""
+        the_median = self.median()
+        start = the_median.credit_minutes
+        inc = minutes(MEDIAN_INCREMENT)
+        if n <= 0: return []
+        if the_median.debit_minutes < 0 or \
+                start + n*inc > minutes(HARD_LIMIT_TOP):
+            return None
+        vacationers = [key for key in self.keyholders.itervalues()
+                       if key.active_on(d) and key.gets_vacation(d)]
+        if the_median in vacationers: return None
+        # The median's own k-th credit sees itself at start + k*inc.
+        the_median.add_increments(d, n, "", start - inc)
+        for key in vacationers:
+            key.add_increments(d, n, "a", start)
+        return vacationers
+
+    def rotate_chart(self, d):
+        """Rotate the chart on date $d$ as many times as the median calls
+        for: each rotation takes ROTATION_MAX - ROTATION_MIN off the median
+        and off every keyholder active on $d$, expiring lameness older than
+        the median's first credit.  Returns the median total after each
+        rotation."""
+        the_median = self.median()
+        amount = minutes(ROTATION_MAX - ROTATION_MIN)
+        keys = self.active_keys(d)
+        # The median is cheap to rotate step by step, and the other
+        # keyholders need its earliest credit date after each step.
+        minmeds = []
+        totals = []
+        while the_median.credit_minutes >= minutes(ROTATION_MAX):
+            the_median.add_lameness(Credit.from_minutes(d, amount))
+            minmeds.append(self.min_median_date())
+            if the_median in keys:
+                the_median.add_lameness(Credit.from_minutes(d, amount))
+                the_median.expire_lameness(minmeds[-1])
+            totals.append(the_median.credit_minutes)
+        for key in keys:
+            if key is not the_median:
+                key.add_rotations(d, amount, minmeds)
+        return totals
+
+    def compute_median(self, d=None):
+        """Computes the median for the list of keyholders active on $d$
+        (today by default).  To make the median advance a little more
+        gradually, it's given as the mean of the keyholders at the 1/3,
+        1/2, and 2/3 level."""
+        if d is None:
+            d = date.today()
+        self.median_index.move_to(d)
+        totals = self.median_index.totals
+        l = len(totals)
+        return timedelta(minutes=(totals[l//3][0] + totals[l//2][0] +
+                                  totals[2*l//3][0]))//3
+
+    ## Snapshots
+    #
+    # Parsing the text files is slow for a big chart, so after a run the
+    # loaded state is pickled along with the size, mtime and MD5 of every
+    # file it came from.  load() uses the snapshot while those still match.
+
+    def source_files(self):
+        return [self.path(x) for x in (KEYHOLDERS_FN, VACATIONS_FN,
+                                       CREDITS_FN, DEBITS_FN, JOURNAL_FN)]
+
+    def write_snapshot(self,fn=None):
+        """Pickle the loaded state.  Only valid right after load() or
+        commit(), while memory and the files agree."""
+        fn = fn or self.path(SNAPSHOT_FN)
+        state = dict(version=SNAPSHOT_VERSION,
+                     sources=[(x, file_signature(x)) for x in self.source_files()],
+                     keyholders=self.keyholders,
+                     record_dates=self.record_dates,
+                     journal_offset=self.journal_offset,
+                     journal_stale=self.journal_stale)
+        tmp = fn + '.tmp'
+        with open(tmp,'wb') as f:
+            cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, fn)
+
+    def load_snapshot(self,fn=None):
+        """Load the state from the snapshot if it is still fresh.  Returns
+        whether it was."""
+        fn = fn or self.path(SNAPSHOT_FN)
+        try:
+            with open(fn,'rb') as f:
+                state = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return False
+        if state.get('version') != SNAPSHOT_VERSION: return False
+        if not snapshot_fresh(state['sources']): return False
+        for key in state['keyholders'].itervalues():
+            key.ledger = self
+        self.keyholders.update(state['keyholders'])
+        self.record_dates = state['record_dates']
+        self.journal_offset = state['journal_offset']
+        self.journal_stale = state['journal_stale']
+        self.median_index.invalidate()
+        return True
+
+    def load(self,snapshot=True,records=True,only=None):
+        """Load the chart from its storage.  Without $records$ only the
+        keyholders and their totals are needed, which storage may take
+        as leave to skip the credit and debit records.  With $only$, a
+        test of a Keyholder, just the keyholders passing it (and the
+        median) are needed; the rest may be left out, in which case the
+        chart can't be saved."""
+        self.storage.load(self, snapshot, records, only)
+
+    def begin_day(self,d):
+        if self.events: self.events.begin_day(d)
+
+    def end_day(self,d,records=None,median=None):
+        """After processing day $d$'s $records$, aiming for $median$."""
+        if self.events and records is not None:
+            self.events.end_day(d, records, median)
+        self.storage.end_day(self, d)
+
+    def save(self):
+        if self.events: self.events.flush()
+        self.storage.save(self)
+        if self.events: self.events.checkpoint()
+
+    def history(self,initials,kind='C',start=date.min,end=date.max):
+        """The credits (C) or debits (D) of keyholder $initials$ dated
+        $start$ to $end$ inclusive, archived ones included in place of
+        their summary records.  Archived credits are cut down by what
+        rotations have since taken off their summary, as they would
+        have been in the ledger; archived debits are given as they
+        were archived (see below)."""
+        records = self.storage.history(self, initials, kind, start, end)
+        if not os.path.exists(self.path(ARCHIVE_FN)):
+            return records
+        archived = self.archived(initials, kind)
+        if kind == 'C':
+            archived = self.unconsumed(initials, archived)
+        return ([x for x in archived if start <= x.date <= end] +
+                [x for x in records if x.flags != SUMMARY_FLAG])
+
+    def unconsumed(self,initials,archived):
+        """What is left of keyholder $initials$'s $archived$ credits
+        once as many minutes are taken off the front as have gone from
+        their summary record, which sits at the front of the credits."""
+        left = sum([x.mins for x in self.storage.history(self, initials, 'C',
+                                                          date.min, date.max)
+                    if x.flags == SUMMARY_FLAG])
+        taken = sum([x.mins for x in archived]) - left
+        kept = []
+        for record in archived:
+            if taken >= record.mins:
+                taken -= record.mins
+                continue
+            if taken > 0:
+                record = Credit.from_minutes(record.date, record.mins - taken,
+                                             record.flags)
+                taken = 0
+            kept.append(record)
+        return kept
+
+    ## Archive
+    #
+    # Old credits and debits can be moved out of the ledger into a
+    # gzipped archive, each keyholder's being replaced by one summary
+    # record (flagged SUMMARY_FLAG) of the same total, dated as the last
+    # of them.  Only totals matter to what becomes of the records later,
+    # so balances come out the same either way.  The median's credits
+    # are left alone, as their dates decide when lameness expires.
+    # expire_lameness can still cancel part of a debit summary against
+    # later make-up records; history() goes on giving the archived
+    # debits in full, so they can add up to more than is left of them.
+    # The archive is only read by history().  Each archiving appends a
+    # gzip member of lines like the journal's, "C|D KEY records".
+
+    def archived(self,initials,kind):
+        """Keyholder $initials$'s archived credits (C) or debits (D)."""
+        if self.archive is None:
+            self.archive = dict()
+            fn = self.path(ARCHIVE_FN)
+            if os.path.exists(fn):
+                with gzip.open(fn,'rb') as f:
+                    for line in f:
+                        fields = line.split()
+                        if not fields: continue
+                        self.archive.setdefault((fields[0], fields[1]), []).extend(
+                            [Credit.from_minutes(from_iso(d), int(m), flags)
+                             for (d, m, flags) in
+                             [debit_re.match(x).groups() for x in fields[2:]]])
+        return self.archive.get((kind, initials), [])
+
+    def archive_before(self,cutoff=None):
+        """Archive the records dated before $cutoff$ (the start of the
+        median range by default), leaving every total as it was.  The
+        ledger then needs saving.  Returns the number of records
+        archived."""
+        cutoff = cutoff or self.min_median_date()
+        if cutoff > self.min_median_date():
+            raise Exception("Records from %s on aren't settled yet."
+                            % self.min_median_date())
+        lines = []
+        count = 0
+        for (name, key) in sorted(self.keyholders.items()):
+            if name == MEDIAN: continue
+            for (kind, records) in (('C', key.credits), ('D', key.debits)):
+                old = [x for x in records if x.date < cutoff]
+                if len(old) < 2: continue
+                detail = [x for x in old if x.flags != SUMMARY_FLAG]
+                if detail:
+                    lines.append('%s %s%s\n' % (kind, name, format_records(detail)))
+                count += len(detail)
+                rest = [x for x in records if x.date >= cutoff]
+                total = sum([x.mins for x in old])
+                if total != 0:
+                    rest.insert(0, Credit.from_minutes(max([x.date for x in old]),
+                                                       total, SUMMARY_FLAG))
+                if kind == 'C':
+                    key.credits = deque(rest)
+                    key.credit_dates = None
+                    key.synced_credits = None
+                else:
+                    key.debits = rest
+                    key.synced_debits = None
+        if lines:
+            # The archive goes to disk before the ledger stops holding
+            # its records.
+            with gzip.open(self.path(ARCHIVE_FN),'ab') as f:
+                f.write(''.join(lines))
+            with open(self.path(ARCHIVE_FN),'ab') as f:
+                os.fsync(f.fileno())
+            self.archive = None
+        return count
+
+    def fork(self):
+        """A copy of the loaded chart to try things out on.  Keyholders
+        share their records with the original until either side changes
+        them, so forking is cheap however much history there is.  The
+        fork is never saved."""
+        ledger = Ledger(self.directory, ScratchStorage())
+        ledger.events = None
+        for key in self.keyholders.itervalues():
+            key.fork(ledger)
+        ledger.record_dates.lo = self.record_dates.lo
+        ledger.record_dates.hi = self.record_dates.hi
+        return ledger
+
+    def drop_keyholders(self,only):
+        """Leave out the keyholders but the median not passing the test
+        $only$.  Returns the initials of those kept."""
+        names = set([key.initials for key in self.keyholders.itervalues()
+                     if key.initials == MEDIAN or only(key)])
+        for initials in self.keyholders.keys():
+            if initials not in names:
+                del self.keyholders[initials]
+        self.median_index.invalidate()
+        return names
+
+    def load_text(self,snapshot=True,only=None):
+        """Load from the text files (or their snapshot).  Returns whether
+        keyholders were left out for $only$.  A fresh snapshot is used
+        either way; only when it is stale are just the wanted keyholders'
+        lines parsed, leaving the snapshot as it was."""
+        if snapshot and self.load_snapshot():
+            if only is None: return False
+            self.drop_keyholders(only)
+            return True
+        self.load_keyholders()
+        names = None
+        if only is not None:
+            names = self.drop_keyholders(only)
+        self.load_vacations(only=names)
+        self.load_credits(only=names)
+        self.load_debits(only=names)
+        self.replay_journal(only=names)
+        if names is not None:
+            return True
+        if snapshot:
+            try:
+                self.write_snapshot()
+            except (IOError, OSError):
+                pass # e.g. a read-only directory; next time parses again
+        return False
+
+# The chart in the current directory, for scripts dealing with just one.
+chart = Ledger()
+
+from_initials = chart.from_initials
+load_keyholders = chart.load_keyholders
+load_vacations = chart.load_vacations
+load_credits = chart.load_credits
+load_debits = chart.load_debits
+write_credits = chart.write_credits
+write_debits = chart.write_debits
+replay_journal = chart.replay_journal
+commit = chart.commit
+compact = chart.compact
+active_keys = chart.active_keys
+min_median_date = chart.min_median_date
+max_median_date = chart.max_median_date
+min_date = chart.min_date
+max_date = chart.max_date
+last_median = chart.last_median
+advance_median = chart.advance_median
+rotate_chart = chart.rotate_chart
+compute_median = chart.compute_median
+write_snapshot = chart.write_snapshot
+load_snapshot = chart.load_snapshot
+load = chart.load
+save = chart.save
 
 if __name__=='__main__':
     load()
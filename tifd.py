@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+# TIFMASTER DAEMON
+#
+# Loads a chart once and serves it over a Unix socket, so tools don't
+# each have to load the whole database.  Each request and each reply
+# is one line of JSON:
+#
+#   {"op": "hours", "lines": ["2016-03-01 AB=2 CD", ...]}
+#       applies hours records like process_hours.py, a day at a time
+#   {"op": "summary"}
+#       the median and every active keyholder's balance
+#   {"op": "history", "initials": "AB", "kind": "C",
+#    "start": "2016-01-01", "end": "2016-03-01"}
+#       a keyholder's credits (C) or debits (D), start and end optional
+#
+# Replies carry "ok", and "error" when it is false.  A single worker
+# thread loads and owns the chart (SQLite connections can't be shared
+# between threads) and applies hours and history requests in turn.
+# An hours request goes in whole or not at all.  Summaries are answered
+# from a copy published after each request, so they never see one half
+# applied.  Changes are saved once the worker has been idle for
+# FLUSH_DELAY seconds, and on shutdown.
+#
+#   tifd.py [-s socket] [chart directory]
+
+import tif
+import process_hours
+import summary
+import SocketServer
+import threading
+import Queue
+import json
+import getopt
+import socket
+import sys
+import os
+from StringIO import StringIO
+
+SOCKET_FN   = "TIF.sock"
+FLUSH_DELAY = 1.0 # seconds idle before saving
+
+class ChartService:
+    """The chart in $directory$ and the worker thread that loads and
+    changes it."""
+    def __init__(self,directory):
+        self.directory = directory
+        self.requests = Queue.Queue()
+        self.dirty = False
+        loaded = Queue.Queue()
+        self.worker = threading.Thread(target=self.work, args=(loaded,))
+        self.worker.daemon = True
+        self.worker.start()
+        error = loaded.get()
+        if error is not None:
+            raise error
+
+    def publish(self):
+        """Replace the view summaries are answered from."""
+        last, rows = summary.standings(self.chart)
+        self.view = dict(ok=True,
+                         median=tif.hours_minutes(last),
+                         last_date=str(self.chart.max_date()),
+                         keyholders=[dict(initials=initials,
+                                          position=tif.hours_minutes(balance),
+                                          vs_median=tif.hours_minutes(balance - last))
+                                     for (initials, balance) in rows])
+
+    def call(self,f,*args):
+        """Run $f$ on the worker thread and return its result."""
+        done = Queue.Queue()
+        self.requests.put((f, args, done))
+        return done.get()
+
+    def work(self,loaded):
+        try:
+            self.chart = tif.Ledger(self.directory)
+            self.chart.load()
+            self.publish()
+        except Exception, e:
+            loaded.put(e)
+            return
+        loaded.put(None)
+        while True:
+            try:
+                (f, args, done) = self.requests.get(timeout=FLUSH_DELAY)
+            except Queue.Empty:
+                if self.dirty: self.flush()
+                continue
+            if f is None:
+                done.put(self.flush())
+                return
+            try:
+                done.put(f(*args))
+            except Exception, e:
+                done.put(dict(ok=False, error=str(e)))
+
+    def flush(self):
+        """Save the chart.  Returns None, or a reply with the error if
+        that failed, leaving the chart dirty so the save is tried again
+        later.  The worker has to outlive a failed save, or every call
+        would wait on it for ever."""
+        try:
+            self.chart.save()
+        except Exception, e:
+            sys.stderr.write("Saving %s failed: %s\n" % (self.directory, e))
+            return dict(ok=False, error="Saving failed: %s" % e)
+        self.dirty = False
+        return None
+
+    def adopt(self,keyholders,record_dates):
+        """Make $keyholders$ and $record_dates$ the chart's state."""
+        self.chart.keyholders.clear()
+        for key in keyholders.itervalues():
+            key.ledger = self.chart
+        self.chart.keyholders.update(keyholders)
+        self.chart.record_dates = record_dates
+        self.chart.median_index.invalidate()
+
+    def apply_hours(self,lines):
+        """Apply the hours $lines$ to a fork of the chart, which takes
+        the chart's place once every day has gone in and, for storage
+        that saves as it goes, been saved.  If anything fails the chart
+        is left as it was, with none of the days logged."""
+        out = StringIO()
+        fork = self.chart.fork()
+        fork.events = events = self.chart.events
+        days = process_hours.add_hours("<request>",
+                                       process_hours.parse_hours_lines("<request>", lines),
+                                       dict(), fork)
+        if not days:
+            return dict(ok=True, days=[], output="")
+        old = (dict(self.chart.keyholders), self.chart.record_dates)
+        logged = len(events.pending)
+        try:
+            for d in sorted(days):
+                process_hours.update_day(d, days[d], fork, out)
+            self.adopt(fork.keyholders, fork.record_dates)
+            self.chart.end_day(max(days)) # e.g. SQLite saves here
+        except:
+            del events.pending[logged:]
+            self.adopt(*old)
+            raise
+        self.dirty = True
+        self.publish()
+        return dict(ok=True, days=[str(d) for d in sorted(days)],
+                    output=out.getvalue())
+
+    def history(self,initials,kind,start,end):
+        if initials not in self.chart.keyholders:
+            return dict(ok=False, error="Keyholder %s not found." % initials)
+        return dict(ok=True,
+                    records=[dict(date=str(x.date), minutes=x.mins, flags=x.flags)
+                             for x in self.chart.history(initials, kind, start, end)])
+
+    def stop(self):
+        """Save and stop the worker.  Returns what flush() did."""
+        return self.call(None)
+
+    def handle(self,request):
+        op = request.get('op')
+        if op == 'summary':
+            return self.view
+        elif op == 'hours':
+            return self.call(self.apply_hours, request.get('lines', []))
+        elif op == 'history':
+            start = request.get('start')
+            end = request.get('end')
+            return self.call(self.history, str(request.get('initials')),
+                             str(request.get('kind', 'C')),
+                             tif.from_iso(start) if start else tif.date.min,
+                             tif.from_iso(end) if end else tif.date.max)
+        return dict(ok=False, error="Unknown op %r." % op)
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip(): continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("A request must be a JSON object.")
+                reply = self.server.service.handle(request)
+            except Exception, e:
+                reply = dict(ok=False, error=str(e))
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def request(path,message):
+    """Send one request to the daemon at $path$ and return the reply."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+    f = s.makefile('rw')
+    f.write(json.dumps(message) + "\n")
+    f.flush()
+    reply = json.loads(f.readline())
+    s.close()
+    return reply
+
+def serve(directory,path):
+    if os.path.exists(path):
+        os.remove(path)
+    server = Server(path, RequestHandler)
+    server.service = ChartService(directory)
+    try:
+        server.serve_forever()
+    finally:
+        server.service.stop()
+        os.remove(path)
+
+if __name__=='__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 's:')
+    directory = args[0] if args else '.'
+    path = os.path.join(directory, SOCKET_FN)
+    for (opt, value) in opts:
+        if opt == '-s': path = value
+    try:
+        serve(directory, path)
+    except KeyboardInterrupt:
+        pass